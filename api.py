@@ -0,0 +1,138 @@
+import sys
+import threading
+import time
+from urllib.parse import urlsplit
+
+from loguru import logger as log
+from requests.adapters import HTTPAdapter
+from vk_api.exceptions import ApiError, Captcha
+
+import net
+import stages
+import util
+
+# https://dev.vk.com/ru/reference/errors
+UNKNOWN = 1
+AUTH_FAILED = 5
+TOO_MANY_RPS = 6
+FLOOD_CONTROL = 9
+SERVER_ERROR = 10
+CAPTCHA = 14
+PARAM_ERROR = 100
+
+# code => (first delay, max delay) in seconds, doubled on every retry
+BACKOFF = {
+    UNKNOWN: (1, 60),
+    TOO_MANY_RPS: (0.5, 8),
+    FLOOD_CONTROL: (30, 600),
+    SERVER_ERROR: (5, 120),
+    CAPTCHA: (30, 600),
+    None: (2, 60),  # network errors and everything else
+}
+
+
+class Redirect(HTTPAdapter):
+    # sends api calls to another server, e.g. fakevk.py
+    def __init__(self, base):
+        super().__init__()
+        self.base = base.rstrip("/")
+
+    def send(self, request, **kw):
+        url = urlsplit(request.url)
+        request.url = self.base + url.path + (f"?{url.query}" if url.query else "")
+        return super().send(request, **kw)
+
+
+def redirect(session, base):
+    for host in ("https://api.vk.ru/", "https://api.vk.com/"):
+        session.http.mount(host, Redirect(base))
+
+
+class Client:
+    # one session for all threads: paced by a token bucket, retried by error code
+    def __init__(self, session, rps=3, none=(), false=(), none_msgs=()):
+        self.session = session
+        self.bucket = util.TokenBucket(rps)
+        self.none = set(none)  # codes that mean "doesn't exist" => None
+        self.false = set(false)  # codes that mean "no access" => False
+        self.none_msgs = none_msgs  # same as `none`, for codes too broad for that
+
+        # pacing and retries are done here, vk_api would sleep under its lock
+        session.RPS_DELAY = 0
+        session.error_handlers.pop(TOO_MANY_RPS, None)
+
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.retries = 0
+        self.throttled = 0.0  # waiting for the bucket
+        self.backed_off = 0.0  # sleeping after errors
+        self.errors = {}  # code => count
+        stages.source("api", self.stats)
+
+    def delay(self, code, attempt):
+        first, cap = BACKOFF.get(code, BACKOFF[None])
+        return net.backoff(first, cap, attempt)
+
+    def method(self, method, values={}):
+        attempt = 0
+        while True:
+            wait = self.bucket.take()
+            with self.lock:
+                self.calls += 1
+                self.throttled += wait
+
+            try:
+                with stages.stage("api"):
+                    return self.session.method(method, values)
+
+            except Captcha as ex:
+                code = CAPTCHA
+                msg = f"captcha {ex.get_url()}"
+
+            except ApiError as ex:
+                code = ex.code
+                msg = ex.error.get("error_msg", "")
+
+                if code in self.none or any(m in msg for m in self.none_msgs):
+                    return None
+                if code in self.false:
+                    return False
+
+                if code == AUTH_FAILED:
+                    log.error("autechre error: " + msg)
+                    sys.exit()
+
+                # a bad request is a bug, the same one every retry
+                if code == PARAM_ERROR:
+                    raise
+
+            except Exception as ex:
+                code = None
+                msg = repr(ex)
+
+            d = self.delay(code, attempt)
+            attempt += 1
+            with self.lock:
+                self.retries += 1
+                self.backed_off += d
+                self.errors[code] = self.errors.get(code, 0) + 1
+
+            log.warning(f"{method!r}: [{code}] {msg}, retry in {d:.1f}s")
+            time.sleep(d)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "calls": self.calls,
+                "retries": self.retries,
+                "throttled": round(self.throttled, 2),
+                "backed_off": round(self.backed_off, 2),
+                "errors": {str(k): v for k, v in self.errors.items()},
+            }
+
+    def summary(self):
+        s = self.stats()
+        return (
+            f"api: {s['calls']} calls, {s['retries']} retries, "
+            f"{s['throttled']}s throttled, {s['backed_off']}s backed off"
+        )
@@ -0,0 +1,356 @@
+#!/usr/bin/env python3
+import argparse
+import datetime
+import ipaddress
+import json
+import os
+import re
+import shutil
+import ssl
+import subprocess
+import sys
+import tempfile
+import time
+import unicodedata
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import requests
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.x509.oid import NameOID
+
+import fakevk
+import net
+import util
+from blank import def_blank, eof_blank, indent, mainfile
+
+SAMPLE_MSG = {
+    "id": 123456,
+    "conversation_message_id": 4321,
+    "date": 1700000000,
+    "from_id": 1234567,
+    "peer_id": 2000000001,
+    "text": "привет, смотри https://vk.com/wall-1_2 " * 4,
+    "attachments": [],
+    "fwd_messages": [],
+}
+
+SAMPLE_HTML = (
+    '<div class="message default clearfix" id="message4321">\n'
+    '    <div class="body">\n'
+    '        <div class="pull_right date details">14/11/23 22:13:20</div>\n'
+    '        <div class="from_name"><a href="https://vk.com/id1">Имя Фамилия</a></div>\n'
+    '        <div class="text">\n%s\n</div>\n'
+    "    </div>\n"
+    "</div>\n"
+) % SAMPLE_MSG["text"]
+
+
+# what people actually send: links, quotes, emoji, long pastes
+SAMPLE_TEXTS = [
+    "ок",
+    "привет, как дела? 😅",
+    'он сказал "<b>нет</b>" & ушёл\nну и ладно',
+    "смотри https://vk.com/wall-1_2 и https://vk.com/wall-1_2 ещё раз",
+    "https://www.youtube.com/watch?v=dQw4w9WgXcQ&t=42s\nhttp://example.com/a/b/c.html",
+    ("длинный текст без ссылок, просто много слов подряд. " * 40).strip(),
+    " ".join(f"https://vk.com/photo1_{i}" for i in range(60)),
+]
+
+SAMPLE_NAMES = [
+    "Иван Петров",
+    "Беседа: «флуд» / оффтоп?",
+    "IMG_2024-01-01 12:00:00.jpg",
+    "💬 чат 2019 (архив) [старый]...",
+    "a" * 300,
+]
+
+
+def old_str_esc(string, url_parse=False):
+    # im.str_esc before util.html_esc / util.linkify
+    url_regex = r"[-a-zA-Zа-яА-Я0-9@:%_\+.~#?&//=]{2,256}\.[a-zA-Zа-яА-Я0-9]{2,4}\b(\/[-a-zA-Zа-яА-Я0-9@:%_\+.~#?&//=]*)?"
+    html_escape_table = {
+        "&": "&amp;",
+        '"': "&quot;",
+        "'": "&apos;",
+        ">": "&gt;",
+        "<": "&lt;",
+        "\n": "<br/>\n" if url_parse else "\n",
+    }
+
+    string = "".join(html_escape_table.get(c, c) for c in string)
+
+    if not url_parse:
+        return string
+
+    replaced = []
+    for match in re.finditer(url_regex, string):
+        mg = match.group()
+        if mg not in replaced and mg.startswith(("http", "vk.com")):
+            replaced.append(mg)
+            string = string.replace(
+                mg, f'<a href="{mg}" title="{mg}">{util.str_cut(mg, 50)}</a>'
+            )
+
+    return string
+
+
+def old_esc(name, replacement="_"):
+    # util.esc before the translate() table and the cache
+    r = []
+    for ch in name:
+        cat = unicodedata.category(ch)
+        if ch in '<>:"/\\|?*' or ch == "\x00":
+            r.append(replacement)
+        elif ch in "()[]{}":
+            r.append(ch)
+        elif cat.startswith(("P", "S", "C")):
+            r.append(replacement)
+        else:
+            r.append(ch)
+
+    r = "".join(r).rstrip(" .")
+    return re.sub(r"_+", "_", r)[:255]
+
+
+def timed(fn, n):
+    start = time.perf_counter()
+    fn(n)
+    return n / (time.perf_counter() - start)
+
+
+def report(name, before, after, unit="msg/s"):
+    print(
+        f"{name:<12} before {before:>12,.0f} {unit}"
+        f"   after {after:>12,.0f} {unit}   x{after / before:.1f}"
+    )
+
+
+def bench_writers(n):
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+
+        def before(n):
+            page, result = tmp / "a.html", tmp / "a.json"
+            for _ in range(n):
+                util.append(page, SAMPLE_HTML)
+
+                s = ",%s"
+                if not os.path.isfile(result):
+                    util.append(result, "[")
+                    s = "%s"
+                util.append(result, s % json.dumps(SAMPLE_MSG, ensure_ascii=False))
+
+        def after(n):
+            with util.Sink(tmp / "b.html") as page, util.Sink(tmp / "b.json") as res:
+                res.write("[")
+                for i in range(n):
+                    page.write(SAMPLE_HTML)
+                    s = ",%s" if i else "%s"
+                    res.write(s % json.dumps(SAMPLE_MSG, ensure_ascii=False))
+
+        report("writers", timed(before, n), timed(after, n))
+
+
+def bench_pages(n):
+    html = def_blank % (
+        1,
+        1,
+        1,
+        "date",
+        "name",
+        "",
+        indent("text<br/>\ntext", 3),
+        "",
+        "",
+    )
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+
+        def page(path, n, prettify):
+            with util.Sink(path) as f:
+                f.write(mainfile % ("title", "info", "title"), "")
+                for _ in range(n):
+                    f.write(indent(html, 4), "")
+                f.write(eof_blank)
+
+            if prettify:
+                util.html_fmt(path)
+
+        def before(n):
+            for i in range(0, n, 1000):
+                page(tmp / f"a{i}.html", min(1000, n - i), True)
+
+        def after(n):
+            for i in range(0, n, 1000):
+                page(tmp / f"b{i}.html", min(1000, n - i), False)
+
+        report("pages", timed(before, n), timed(after, n))
+
+
+def bench_escape(n):
+    def run(fn):
+        def loop(n):
+            for i in range(n):
+                text = SAMPLE_TEXTS[i % len(SAMPLE_TEXTS)]
+                fn(text)
+                fn(text, True)
+
+        return loop
+
+    report("escape", timed(run(old_str_esc), n), timed(run(util_str_esc), n))
+
+
+def util_str_esc(string, url_parse=False):
+    # same as im.str_esc, without importing im
+    return util.linkify(string) if url_parse else util.html_esc(string)
+
+
+def bench_filenames(n):
+    # every name different and the lru cache of util.esc left out, a dump
+    # rarely escapes the same name twice
+    names = [f"{SAMPLE_NAMES[i % len(SAMPLE_NAMES)]} {i}" for i in range(n)]
+
+    def run(fn):
+        def loop(n):
+            for name in names[:n]:
+                fn(name)
+
+        return loop
+
+    new_esc = util.esc.__wrapped__
+    report("filenames", timed(run(old_esc), n), timed(run(new_esc), n), "name/s")
+
+
+def du(path, skip=()):
+    total = 0
+    for root, dirs, files in os.walk(path):
+        dirs[:] = [d for d in dirs if d not in skip]
+        total += sum(os.lstat(os.path.join(root, f)).st_size for f in files)
+    return total
+
+
+def bench_e2e(n):
+    # whole im.py against fakevk.py: api, media downloads, thumbnails, html
+    here = Path(__file__).resolve().parent
+    server = fakevk.Server(fakevk.corpus(n))
+    base = server.start()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        shutil.copytree(here / "blank", Path(tmp, "blank"))
+        cmd = [sys.executable, str(here / "im.py"), "--auth", "x" * 85]
+        cmd += ["--api", base, "--rps", "1000", "--novideo", "--nomusic", "@1"]
+
+        start = time.perf_counter()
+        p = subprocess.Popen(
+            cmd, cwd=tmp, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE
+        )
+        # wait4 gives the child's own rusage, peak rss included
+        _, status, usage = os.wait4(p.pid, 0)
+        elapsed = time.perf_counter() - start
+        p.returncode = os.waitstatus_to_exitcode(status)
+        err = p.stderr.read().decode(errors="replace")
+        written = du(tmp, skip={"blank"})
+
+    server.stop()
+    if p.returncode:
+        print(err[-2000:])
+        sys.exit(f"im.py exited with {p.returncode}")
+
+    calls = sum(server.calls.values())
+    print(
+        f"{'e2e':<12} {n / elapsed:>12,.0f} msg/s   {elapsed:.1f}s   {calls} api calls   "
+        f"{written / 1e6:.1f} MB written   {server.media_bytes / 1e6:.1f} MB fetched   "
+        f"{usage.ru_maxrss / 1024:.0f} MB peak rss"
+    )
+    print(f"{'':<12} " + ", ".join(f"{k} {v}" for k, v in server.calls.most_common()))
+
+
+def self_signed(tmp):
+    # a cert for 127.0.0.1, so the local server does real tls handshakes
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "127.0.0.1")])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    san = x509.SubjectAlternativeName(
+        [x509.IPAddress(ipaddress.ip_address("127.0.0.1"))]
+    )
+    cert = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - datetime.timedelta(days=1))
+        .not_valid_after(now + datetime.timedelta(days=1))
+        .add_extension(san, critical=False)
+        .sign(key, hashes.SHA256())
+    )
+
+    cert_path, key_path = Path(tmp, "cert.pem"), Path(tmp, "key.pem")
+    cert_path.write_bytes(cert.public_bytes(serialization.Encoding.PEM))
+    key_path.write_bytes(
+        key.private_bytes(
+            serialization.Encoding.PEM,
+            serialization.PrivateFormat.PKCS8,
+            serialization.NoEncryption(),
+        )
+    )
+    return cert_path, key_path
+
+
+def bench_http(n):
+    # small files from one host over https, 8 threads like the media pools;
+    # a fresh handshake per file is slow, a few thousand show it well enough
+    n = min(n, 5000)
+    with tempfile.TemporaryDirectory() as tmp:
+        cert, key = self_signed(tmp)
+        ctx = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        ctx.load_cert_chain(cert, key)
+
+        server = fakevk.Server([], ssl=ctx)
+        base = server.start()
+        urls = [f"{base}/media/seg{i}.ts" for i in range(n)]
+
+        def run(get):
+            def loop(n):
+                with ThreadPoolExecutor(8) as ex:
+                    for r in ex.map(get, urls[:n]):
+                        assert r.content
+
+            return loop
+
+        def before(url):
+            return requests.get(url, timeout=15, verify=cert)
+
+        def after(url):
+            return net.get(url, verify=cert)
+
+        report("http", timed(run(before), n), timed(run(after), n), "file/s")
+        s = net.stats()
+        print(f"{'':<12} {s['requests']} requests over {s['connections']} connections")
+        server.stop()
+
+
+BENCHES = {
+    "writers": bench_writers,
+    "pages": bench_pages,
+    "escape": bench_escape,
+    "filenames": bench_filenames,
+    "http": bench_http,
+    "e2e": bench_e2e,
+}
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-n", type=int, default=20000, help="iterations per bench")
+    ap.add_argument("benches", nargs="*", help=f"any of: {', '.join(BENCHES)}")
+    args = ap.parse_args()
+
+    if unknown := set(args.benches) - set(BENCHES):
+        ap.error(f"unknown bench: {', '.join(unknown)}")
+
+    for name in args.benches or BENCHES:
+        BENCHES[name](args.n)
@@ -1,3 +1,5 @@
+import re
+
 mainfile = (
     "<!DOCTYPE html>\n"
     "<html>\n"
@@ -22,13 +24,19 @@ mainfile = (
     "                            </a>\n"
     "                        </div>\n"
     "                    </div>\n"
+    '                    <input class="pull_right search_input" type="search" placeholder="Поиск" onkeydown="return SearchKey(event, this);" />\n'
     "                </div>\n"
     "            </div>\n"
     "        </div>\n"
+    '        <div class="search_results" id="search_results"></div>\n'
     '        <div class="page_body chat_page">\n'
     '            <div class="history">\n'
 )
 
+eof_blank = "            </div>\n        </div>\n    </div>\n</body>\n\n</html>"
+
+page_blank = '                <a class="pagination block_link" href="messages%s.html">%s ( %s )</a>\n'
+
 def_blank = (
     '<div class="message default clearfix" id="message%s">\n'
     '    <div class="pull_left userpic_wrap">\n'
@@ -42,11 +50,11 @@ def_blank = (
     '        <div class="pull_right date details">%s</div>\n'
     '        <div class="from_name">%s</div>\n'
     "%s"  # reply_message, fwd_messages
-    '        <div class="text">\n%s\n</div>\n'
+    '        <div class="text">\n%s\n        </div>\n'
     "%s"  # fwd_text_prefix, pre_attachments
     "    </div>\n"
     "</div>\n"
-    "%s\n"  # post_attachments
+    "%s"  # post_attachments
 )
 
 fwd_blank = (
@@ -62,7 +70,7 @@ fwd_blank = (
     '        %s<span class="details"> %s</span>\n'
     "    </div>\n"
     "%s"  # reply_message, fwd_messages
-    '    <div class="text">\n%s</div>\n'
+    '    <div class="text">\n%s\n    </div>\n'
     "%s"  # fwd_text_prefix, pre_attachments
     "</div>\n"
     "%s"  # post_attachments
@@ -70,15 +78,50 @@ fwd_blank = (
 )
 
 jnd_blank = (
-    '<div class="message default clearfix joined" id="%s">\n'
+    '<div class="message default clearfix joined" id="message%s">\n'
     '    <!-- joined-id%s-id%s" -->\n'
     '    <div class="body">\n'
     '        <div class="pull_right date details">%s</div>\n'
     '    <!-- joined-name %s" -->\n'
     "%s"  # reply_message, fwd_messages
-    '        <div class="text">\n%s</div>\n'
+    '        <div class="text">\n%s\n        </div>\n'
     "%s"  # fwd_text_prefix, pre_attachments
     "    </div>\n"
     "</div>\n"
-    "%s\n"  # post_attachments
+    "%s"  # post_attachments
+)
+
+srv_blank = (
+    '<div class="message service" id="message%s">\n'
+    '    <div class="body details">\n'
+    "%s\n"
+    "    </div>\n"
+    "</div>\n"
+)
+
+data_blank = (
+    "%s\n"
+    '    <div class="fill pull_left"></div>\n'
+    '    <div class="body">\n'
+    '        <div class="title bold">%s</div>\n'
+    '        <div class="status details">%s</div>\n'
+    "    </div>\n"
+    "</a>\n"
+)
+
+media_blank = '<div class="media_wrap clearfix">\n%s</div>\n'
+
+joined_blank = (
+    '<div class="message default clearfix joined">\n'
+    '    <div class="body">\n'
+    "%s"
+    "    </div>\n"
+    "</div>\n"
 )
+
+_line_start = re.compile(r"^(?=.)", re.M)
+
+
+def indent(html, level=1):
+    # shifts every non-empty line of a fragment by `level` * 4 spaces
+    return _line_start.sub("    " * level, html) if html else html
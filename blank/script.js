@@ -187,3 +187,272 @@ function GoBack(anchor) {
     }, 100);
     return false;
 }
+
+// attachments json lives in messagesN.attachments.js next to the page,
+// it's loaded on the first hover over an attachment
+window.PageAttachmentsData = {};
+window.PageAttachmentsState = 0; // 0 - not loaded, 1 - loading, 2 - loaded
+window.PageAttachmentsQueue = [];
+
+function PageAttachments(messageId, list) {
+    window.PageAttachmentsData[messageId] = list;
+}
+
+function LoadAttachments(callback) {
+    if (window.PageAttachmentsState == 2) {
+        callback();
+        return;
+    }
+    window.PageAttachmentsQueue.push(callback);
+    if (window.PageAttachmentsState == 1) {
+        return;
+    }
+    window.PageAttachmentsState = 1;
+
+    var page = location.pathname.split("/").pop().replace(/\.html$/, "");
+    var script = document.createElement("script");
+    script.src = page + ".attachments.js";
+    script.onload = script.onerror = function () {
+        window.PageAttachmentsState = 2;
+        var queue = window.PageAttachmentsQueue;
+        window.PageAttachmentsQueue = [];
+        for (var i = 0; i < queue.length; i++) {
+            queue[i]();
+        }
+    };
+    document.head.appendChild(script);
+}
+
+function ShowAttachment(element) {
+    if (element.title) {
+        return;
+    }
+    var ref = element.getAttribute("data-att").split("/");
+    LoadAttachments(function () {
+        var list = window.PageAttachmentsData[ref[0]];
+        var attachment = list ? list[parseInt(ref[1])] : null;
+        if (attachment) {
+            element.title = JSON.stringify(attachment, null, 10);
+        }
+    });
+}
+
+document.addEventListener("mouseover", function (e) {
+    var element = e.target;
+    while (element && element.getAttribute) {
+        if (element.getAttribute("data-att") !== null) {
+            ShowAttachment(element);
+            return;
+        }
+        element = element.parentNode;
+    }
+});
+
+// search/ next to the pages: meta.js, sN.js with token => [[page, pos, ...]]
+// and pN.js with [anchor, date, name, snippet] of every message of page N
+window.SearchData = { meta: null, shards: {}, docs: {} };
+window.SearchScripts = {}; // src => callbacks while loading, true when done
+window.SearchLimit = 100;
+
+function SearchMeta(key, meta) {
+    window.SearchData.meta = meta;
+}
+
+function SearchShard(n, postings) {
+    window.SearchData.shards[n] = postings;
+}
+
+function SearchDocs(page, docs) {
+    window.SearchData.docs[page] = docs;
+}
+
+function LoadScript(src, callback) {
+    var state = window.SearchScripts[src];
+    if (state === true) {
+        callback();
+        return;
+    }
+    if (state) {
+        state.push(callback);
+        return;
+    }
+    window.SearchScripts[src] = [callback];
+
+    var script = document.createElement("script");
+    script.src = src;
+    script.onload = script.onerror = function () {
+        var queue = window.SearchScripts[src];
+        window.SearchScripts[src] = true;
+        for (var i = 0; i < queue.length; i++) {
+            queue[i]();
+        }
+    };
+    document.head.appendChild(script);
+}
+
+function LoadScripts(list, callback) {
+    var left = list.length;
+    if (!left) {
+        callback();
+        return;
+    }
+    for (var i = 0; i < list.length; i++) {
+        LoadScript(list[i], function () {
+            if (--left == 0) {
+                callback();
+            }
+        });
+    }
+}
+
+// same as search.tokens and search.shard
+function SearchTokens(text) {
+    var words = text.toLowerCase().replace(/ё/g, "е").match(/[\p{L}\p{N}_]+/gu) || [];
+    var seen = {};
+    var tokens = [];
+    for (var i = 0; i < words.length; i++) {
+        var w = words[i];
+        if (w.length >= 2 && w.length <= 32 && !seen[w]) {
+            seen[w] = true;
+            tokens.push(w);
+        }
+    }
+    return tokens;
+}
+
+function SearchShardOf(token, n) {
+    var h = 2166136261;
+    for (var i = 0; i < token.length; i++) {
+        h ^= token.charCodeAt(i);
+        h = Math.imul(h, 16777619) >>> 0;
+    }
+    return h % n;
+}
+
+function SearchKey(event, input) {
+    if (event.key == "Enter") {
+        Search(input.value);
+        return false;
+    }
+    if (event.key == "Escape") {
+        input.value = "";
+        ShowSearchResults(null);
+    }
+    return true;
+}
+
+function Search(query) {
+    var tokens = SearchTokens(query);
+    if (!tokens.length) {
+        ShowSearchResults(null);
+        return;
+    }
+    LoadScript("search/meta.js", function () {
+        var meta = window.SearchData.meta;
+        if (!meta) {
+            ShowToast("Нет поискового индекса, он строится при дампе.");
+            return;
+        }
+        var shards = [];
+        for (var i = 0; i < tokens.length; i++) {
+            shards.push("search/s" + SearchShardOf(tokens[i], meta.shards) + ".js");
+        }
+        LoadScripts(shards, function () {
+            SearchFound(tokens, meta);
+        });
+    });
+}
+
+function SearchPostings(token, meta) {
+    // "page:pos" => [page, pos]
+    var shard = window.SearchData.shards[SearchShardOf(token, meta.shards)] || {};
+    var found = {};
+    var pages = shard[token] || [];
+    for (var i = 0; i < pages.length; i++) {
+        for (var j = 1; j < pages[i].length; j++) {
+            found[pages[i][0] + ":" + pages[i][j]] = [pages[i][0], pages[i][j]];
+        }
+    }
+    return found;
+}
+
+function SearchFound(tokens, meta) {
+    var lists = [];
+    for (var i = 0; i < tokens.length; i++) {
+        lists.push(SearchPostings(tokens[i], meta));
+    }
+    lists.sort(function (a, b) {
+        return Object.keys(a).length - Object.keys(b).length;
+    });
+
+    // every word of the query, rarest first
+    var hits = [];
+    for (var key in lists[0]) {
+        var all = true;
+        for (var k = 1; k < lists.length && all; k++) {
+            all = key in lists[k];
+        }
+        if (all) {
+            hits.push(lists[0][key]);
+        }
+    }
+    hits.sort(function (a, b) {
+        return b[0] - a[0] || b[1] - a[1];
+    });
+
+    var shown = hits.slice(0, window.SearchLimit);
+    var pages = {};
+    for (var h = 0; h < shown.length; h++) {
+        pages["search/p" + shown[h][0] + ".js"] = true;
+    }
+    LoadScripts(Object.keys(pages), function () {
+        ShowSearchResults(shown, hits.length);
+    });
+}
+
+function ShowSearchResults(hits, total) {
+    var box = document.getElementById("search_results");
+    while (box.firstChild) {
+        box.removeChild(box.firstChild);
+    }
+    if (!hits) {
+        RemoveClass(box, "search_shown");
+        return;
+    }
+    AddClass(box, "search_shown");
+
+    var head = box.appendChild(document.createElement("div"));
+    head.className = "search_head details";
+    head.appendChild(document.createTextNode(
+        "Найдено: " + total + (total > hits.length ? ", показаны последние " + hits.length : "")
+    ));
+
+    var here = location.pathname.split("/").pop();
+    for (var i = 0; i < hits.length; i++) {
+        var docs = window.SearchData.docs[hits[i][0]] || [];
+        var doc = docs[hits[i][1]];
+        if (!doc) {
+            continue;
+        }
+        var page = "messages" + hits[i][0] + ".html";
+        var link = box.appendChild(document.createElement("a"));
+        link.className = "search_hit block_link";
+        link.href = page + "#go_to_message" + doc[0];
+        if (page == here) {
+            link.onclick = (function (anchor) {
+                return function () {
+                    return GoToMessage(anchor);
+                };
+            })(doc[0]);
+        }
+
+        var info = link.appendChild(document.createElement("div"));
+        info.className = "details";
+        var date = new Date(doc[1] * 1000).toLocaleString();
+        info.appendChild(document.createTextNode(date + ", стр. " + hits[i][0] + " — " + doc[2]));
+
+        var text = link.appendChild(document.createElement("div"));
+        text.className = "text";
+        text.appendChild(document.createTextNode(doc[3]));
+    }
+}
@@ -0,0 +1,375 @@
+#!/usr/bin/env python3
+# local stand-in for the vk api and its media servers, for benchmarks
+import argparse
+import asyncio
+import io
+import json
+import random
+import threading
+from collections import Counter
+
+from aiohttp import web
+from PIL import Image
+
+MEDIA = "{media}"  # replaced with the server url in responses
+PEER = 2000000001
+ME = 1
+
+SERVICE = [
+    "chat_create",
+    "chat_title_update",
+    "chat_invite_user_by_link",
+    "chat_photo_update",
+    "chat_photo_remove",
+    "chat_pin_message",
+    "chat_unpin_message",
+    "chat_invite_user",
+    "chat_kick_user",
+]
+
+WORDS = (
+    "привет как дела что делаешь завтра встреча в шесть ок давай "
+    "смотри это видео ну такое себе lol да нет может быть потом"
+).split()
+
+
+def text(rnd):
+    words = rnd.choices(WORDS, k=rnd.randint(1, 30))
+    if rnd.random() < 0.15:
+        words.append(f"https://vk.com/wall-{rnd.randint(1, 999)}_{rnd.randint(1, 99)}")
+    if rnd.random() < 0.1:
+        words.insert(0, '<b>"цитата"</b> &')
+    return " ".join(words).replace(" потом", "\nпотом")
+
+
+def photo(rnd, i):
+    w, h = rnd.choice([(1280, 960), (604, 453), (130, 97), (2560, 1440)])
+    return {
+        "id": 1000 + i % 700,  # some photos are forwarded over and over
+        "owner_id": rnd.randint(1, 50),
+        "date": 1600000000 + i,
+        "sizes": [
+            {"type": "m", "url": f"{MEDIA}/ph{i}m.jpg", "width": 130, "height": 97},
+            {"type": "x", "url": f"{MEDIA}/ph{i % 700}.jpg", "width": w, "height": h},
+        ],
+    }
+
+
+def attachment(rnd, kind, i, from_id):
+    o, n = rnd.randint(1, 50), 100 + i
+    match kind:
+        case "photo":
+            return {"photo": photo(rnd, i)}
+        case "video":
+            return {"video": {"owner_id": o, "id": n, "title": "видео", "duration": 95}}
+        case "audio":
+            a = {"owner_id": o, "id": n, "artist": "Артист", "title": "Трек"}
+            return {"audio": {**a, "duration": 200}}
+        case "wall":
+            return {"wall": {"to_id": -o, "id": n}}
+        case "poll":
+            return {"poll": {"owner_id": o, "id": n, "question": "куда?"}}
+        case "gift":
+            return {"gift": {"id": n, "thumb_256": f"{MEDIA}/gift{n}.jpg"}}
+        case "link":
+            return {
+                "link": {
+                    "url": "https://example.com/a",
+                    "title": "Ссылка",
+                    "caption": "example.com",
+                }
+            }
+        case "market":
+            return {
+                "market": {
+                    "owner_id": -o,
+                    "id": n,
+                    "title": "Товар",
+                    "price": {"text": "100 ₽"},
+                }
+            }
+        case "wall_reply":
+            return {"wall_reply": {"owner_id": -o, "post_id": n, "id": n + 1}}
+        case "doc":
+            d = {
+                "owner_id": o,
+                "id": n % 300,
+                "title": f"файл {n % 300}.pdf",
+                "ext": "pdf",
+            }
+            return {"doc": {**d, "url": f"{MEDIA}/doc{n % 300}.pdf", "size": 32768}}
+        case "call":
+            state = rnd.choice(
+                ["canceled_by_initiator", "canceled_by_receiver", "reached"]
+            )
+            c = {"initiator_id": from_id, "video": rnd.random() < 0.3, "state": state}
+            return {"call": {**c, "duration": 61}}
+        case "graffiti":
+            g = {"owner_id": o, "id": n, "url": f"{MEDIA}/gr{n}.jpg"}
+            return {"graffiti": {**g, "width": 720, "height": 720}}
+        case "audio_message":
+            a = {"owner_id": o, "id": n, "duration": 7}
+            return {"audio_message": {**a, "link_ogg": f"{MEDIA}/voice{n}.ogg"}}
+        case "sticker":
+            s = rnd.randint(1, 60)
+            images = [{"url": f"{MEDIA}/st{s}_{k}.png"} for k in (64, 128, 256)]
+            return {"sticker": {"sticker_id": s, "images": images}}
+
+
+KINDS = [
+    "photo", "video", "audio", "wall", "poll", "gift", "link", "market",
+    "wall_reply", "doc", "call", "graffiti", "audio_message", "sticker",
+]  # fmt: skip
+
+
+def message(rnd, i, cmid, users):
+    from_id = rnd.choice(users)
+    m = {
+        "date": 1600000000 + i * 37,
+        "from_id": from_id,
+        "text": text(rnd),
+        "attachments": [],
+        "conversation_message_id": cmid,
+    }
+
+    if rnd.random() < 0.35:
+        kinds = rnd.choices(
+            KINDS, weights=[40] + [4] * (len(KINDS) - 1), k=rnd.randint(1, 3)
+        )
+        m["attachments"] = [
+            {"type": k, **attachment(rnd, k, i, from_id)} for k in kinds
+        ]
+
+    if rnd.random() < 0.02:
+        geo = {"coordinates": {"latitude": 55.75, "longitude": 37.61}}
+        m["geo"] = {**geo, "place": {"title": "Москва"}}
+
+    return m
+
+
+def quotes(rnd, m, msgs):
+    # earlier messages of the chat, the first few are quoted over and over;
+    # forwards keep their own forwards, so chains get deep now and then
+    if rnd.random() < 0.1:
+        q = rnd.choice(msgs[-20:] + msgs[:5])
+        m["reply_message"] = {
+            k: v for k, v in q.items() if k not in ("reply_message", "fwd_messages")
+        }
+    if rnd.random() < 0.05:
+        n = min(len(msgs), rnd.randint(1, 4))
+        m["fwd_messages"] = [
+            {k: v for k, v in q.items() if k != "reply_message"}
+            for q in rnd.sample(msgs[-50:], n)
+        ]
+
+
+def service(rnd, i, cmid, users):
+    kind = SERVICE[i % len(SERVICE)]
+    action = {"type": kind, "text": "беседа", "member_id": rnd.choice(users)}
+    m = {"date": 1600000000 + i * 37, "from_id": rnd.choice(users), "text": ""}
+    m |= {"conversation_message_id": cmid, "attachments": [], "action": action}
+
+    if kind == "chat_photo_update":
+        m["attachments"] = [{"type": "photo", "photo": photo(rnd, i)}]
+    if kind in ("chat_pin_message", "chat_unpin_message"):
+        action["conversation_message_id"] = max(cmid - 1, 1)
+        action["message"] = "закреп"
+
+    return m
+
+
+def corpus(n, peer=PEER, users=50, groups=5, seed=1):
+    # oldest first, ids with gaps like after deletions
+    rnd = random.Random(seed)
+    members = list(range(1, users + 1)) + [-g for g in range(1, groups + 1)]
+    msgs = []
+    for i in range(1, n + 1):
+        if rnd.random() < 0.03:
+            m = service(rnd, i, i, members)
+        else:
+            m = message(rnd, i, i, members)
+            if msgs:
+                quotes(rnd, m, msgs)
+        msgs.append({"id": i * 2, "peer_id": peer, **m})
+    return msgs
+
+
+def jpeg(w=800, h=600):
+    buf = io.BytesIO()
+    Image.linear_gradient("L").resize((w, h)).convert("RGB").save(buf, "JPEG")
+    return buf.getvalue()
+
+
+class Server:
+    def __init__(self, msgs, peer=PEER, host="127.0.0.1", port=0, ssl=None):
+        self.msgs = msgs
+        self.newest = msgs[::-1]
+        self.peer = peer
+        self.host, self.port = host, port
+        self.ssl = ssl  # ssl.SSLContext => https, handshakes cost what they do
+        self.base = ""
+        self.calls = Counter()
+        self.media_bytes = 0
+        self.jpeg = jpeg()
+        self.blob = bytes(range(256)) * 128
+        self.loop = None
+        self.started = threading.Event()
+
+    # api methods
+
+    def history(self, v):
+        count = int(v.get("count", 20))
+        offset = int(v.get("offset", 0))
+        items = self.msgs if int(v.get("rev", 0)) else self.newest
+
+        if "start_message_id" in v:
+            start = int(v["start_message_id"])
+            pos = next((k for k, m in enumerate(items) if m["id"] <= start), len(items))
+            offset += pos
+
+        # negative offset goes towards newer messages
+        lo = max(offset, 0)
+        return {"count": len(self.msgs), "items": items[lo : lo + count]}
+
+    def execute(self, v):
+        # HISTORY_CODE of im.py, the only script it sends
+        cursor, pages = int(v["start_message_id"]), int(v["pages"])
+        r = []
+        while pages > 0:
+            q = {"count": 200, "offset": -200, "start_message_id": cursor}
+            page = self.history(q)["items"]
+            r.append(page)
+            if not page or page[0]["id"] <= cursor:
+                break
+            cursor = page[0]["id"]
+            pages -= 1
+        return r
+
+    def users(self, v):
+        ids = [int(i) for i in str(v.get("user_ids", ME)).split(",") if i]
+        return [
+            {
+                "id": i,
+                "first_name": "Имя",
+                "last_name": f"Фамилия{i}",
+                "photo_200": f"{MEDIA}/u{i}.jpg",
+            }
+            for i in ids
+        ]
+
+    def groups(self, v):
+        ids = [int(i) for i in str(v.get("group_ids", "")).split(",") if i]
+        return [
+            {"id": i, "name": f"Группа {i}", "photo_200": f"{MEDIA}/g{i}.jpg"}
+            for i in ids
+        ]
+
+    def conversations(self, v):
+        conv = {
+            "peer": {
+                "id": self.peer,
+                "type": "chat",
+                "local_id": self.peer - 2000000000,
+            },
+            "last_message_id": self.msgs[-1]["id"] if self.msgs else 0,
+            "chat_settings": {"title": "Бенчмарк", "members_count": 55},
+        }
+        r = {"count": 1, "items": []}
+        if int(v.get("count", 0)):
+            r["items"] = [{"conversation": conv, "last_message": self.newest[0]}]
+
+        # senders of the chat, as users.get / groups.getById would give them
+        if v.get("extended") and r["items"]:
+            peers = {m["from_id"] for m in self.msgs}
+            u_ids = ",".join(str(p) for p in sorted(peers) if p > 0)
+            g_ids = ",".join(str(-p) for p in sorted(peers) if p < 0)
+            r["profiles"] = self.users({"user_ids": u_ids})
+            r["groups"] = self.groups({"group_ids": g_ids})
+        return r
+
+    def chat(self, v):
+        return {
+            "title": "Бенчмарк",
+            "admin_id": ME,
+            "members_count": 55,
+            "photo_200": f"{MEDIA}/chat.jpg",
+        }
+
+    # http
+
+    async def method(self, request):
+        name = request.match_info["name"]
+        v = {**request.query, **(await request.post())}
+        self.calls[name] += 1
+
+        handlers = {
+            "messages.getHistory": self.history,
+            "execute": self.execute,
+            "users.get": self.users,
+            "groups.getById": self.groups,
+            "messages.getConversations": self.conversations,
+            "messages.getChat": self.chat,
+        }
+        if name not in handlers:
+            error = {"error_code": 3, "error_msg": "Unknown method passed"}
+            return web.json_response({"error": error})
+
+        body = json.dumps({"response": handlers[name](v)}, ensure_ascii=False)
+        body = body.replace(MEDIA, self.base + "/media")
+        return web.Response(text=body, content_type="application/json")
+
+    async def media(self, request):
+        name = request.match_info["name"]
+        data = self.jpeg if name.endswith(".jpg") else self.blob
+        self.media_bytes += len(data)
+        return web.Response(body=data)
+
+    async def serve(self):
+        app = web.Application()
+        app.router.add_route("*", "/method/{name}", self.method)
+        app.router.add_get("/media/{name}", self.media)
+
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        site = web.TCPSite(runner, self.host, self.port, ssl_context=self.ssl)
+        await site.start()
+
+        port = site._server.sockets[0].getsockname()[1]
+        scheme = "https" if self.ssl else "http"
+        self.base = f"{scheme}://{self.host}:{port}"
+        self.started.set()
+
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await runner.cleanup()
+
+    def start(self):
+        # runs in a thread of its own, returns the base url
+        def run():
+            self.loop = asyncio.new_event_loop()
+            self.task = self.loop.create_task(self.serve())
+            try:
+                self.loop.run_until_complete(self.task)
+            except asyncio.CancelledError:
+                pass
+
+        self.thread = threading.Thread(target=run, daemon=True)
+        self.thread.start()
+        self.started.wait()
+        return self.base
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.task.cancel)
+        self.thread.join()
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-n", type=int, default=10000, help="messages in the chat")
+    ap.add_argument("-p", "--port", type=int, default=8080)
+    args = ap.parse_args()
+
+    server = Server(corpus(args.n), port=args.port)
+    print(f"{server.start()}, im.py --api {server.base} --auth {'x' * 85} @1")
+    server.thread.join()
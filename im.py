@@ -1,31 +1,95 @@
 #!/usr/bin/env python3
 from datetime import datetime, timedelta
+import itertools
 import sys
 import json
+import math
+import re
 import time
 import random
 import os
-import io
-import re
-import pathlib
 import shutil
+import threading
 import requests
 import argparse
-
-from blank import mainfile, def_blank, fwd_blank, jnd_blank
+import atexit
+
+from blank import mainfile, eof_blank, page_blank, def_blank, fwd_blank, jnd_blank
+from blank import srv_blank, data_blank, media_blank, joined_blank, indent
+from concurrent.futures import ThreadPoolExecutor
+from api import Client, redirect as api_redirect
+from media import MediaQueue, parse_limits
+from manifest import Manifest
+from profiles import Profiles
+from store import Store
+from thumbs import Thumbs
+from video import Videos
 import mu
+import net
+import search
+import stages
 import util
 
-import yt_dlp
-from PIL import Image
-from tabulate import tabulate
 from loguru import logger as log
 from vk_api import VkApi, audio
 from vk_api.exceptions import AuthError, Captcha
 
-prev_id = prev_date = offset_count = items_done = 0
 vk_cookies = "# Netscape HTTP Cookie File\n"
-progress_str = ""
+
+
+COMPRESS = {None: "", "gzip": ".gz"}
+
+# rendered quotes kept per dialog
+QUOTE_CACHE = 2048
+
+archives = {}  # archive dir => (Store, Manifest), see archive()
+archives_lock = threading.Lock()
+
+# up to `pages` chunks newer than start_message_id, each one anchored to the
+# newest message of the previous one; stops once nothing newer comes back
+HISTORY_CODE = """
+var cursor = parseInt(Args.start_message_id);
+var pages = parseInt(Args.pages);
+var items = [];
+while (pages > 0) {
+    var page = API.messages.getHistory({
+        "peer_id": Args.peer_id, "count": 200, "offset": -200,
+        "start_message_id": cursor
+    }).items;
+    items.push(page);
+    if (page.length == 0 || page[0].id <= cursor) {
+        pages = 0;
+    } else {
+        cursor = page[0].id;
+        pages = pages - 1;
+    }
+}
+return items;
+"""
+
+
+class Dump:
+    # everything one dialog needs while it's being dumped
+    def __init__(self, target):
+        self.target = target
+        self.root = os.getcwd()
+        self.title = ""
+        self.users = {}
+        self.prev_id = self.prev_date = self.items_done = 0
+        self.progress_str = ""
+        self.out = {}
+        self.header = ""
+        self.ckpt = {}
+        self.store = None  # object store of the archive
+        self.manifest = None  # files of the archive, instead of asking the disk
+        self.msg_id = 0  # message being rendered
+        self.att = []  # its attachments, forwards included
+        self.index = None  # search index, None with --nosearch
+        self.quotes = util.LRU(QUOTE_CACHE)  # quote key => (html, attachments)
+        self.missing = []  # (href, vk link) of media that failed in the pool
+
+    def path(self, *parts):
+        return os.path.join(self.root, *parts)
 
 
 def progress(string, force=False):
@@ -33,99 +97,219 @@ def progress(string, force=False):
         log.info(string)
         return
 
-    print(" " * os.get_terminal_size().columns, end="\r")
+    print(" " * shutil.get_terminal_size().columns, end="\r")
     print(string, end="\r")
 
 
-def rqst_file(url, path):
-    if not url:
+def rqst_file(url, path, tag=""):
+    # nothing is downloaded while re-rendering
+    if not url or args.render:
         return
 
-    # TODO: bytes mismatch detection
-    if os.path.exists(path) and not args.rewrite:
-        return
+    # `path` is a temp file of the store, the manifest said it's not in the
+    # dump; only a complete file is ever renamed to it
+    shown, dw_len = 0.0, ""
+
+    def show(done, total):
+        # the size first, then every 2 seconds
+        nonlocal shown, dw_len
+        now = time.time()
+        if not shown:
+            shown, dw_len = now, util.float_fmt((total or 10000) / 1048576, 2)
+            progress(f"{tag} | {dw_len}MB {path}")
+        elif now - shown > 2:
+            shown = now
+            dw_now = util.float_fmt(done / 1048576, 2)
+            progress(f"{tag} | {dw_now}MB / {dw_len}MB {path}", True)
+
+    try:
+        net.download(url, path, progress=show)
+    except requests.HTTPError as ex:
+        log.error(f"({ex.response.status_code}) {path}")
+    except net.Incomplete as ex:
+        log.error(f"{tag} | {ex} {path}")
+    except Exception:
+        log.error(f"{tag} | timeout {path}")
 
-    block_size = 1024
-    max_tries = 5
-    dw_total = 0
 
-    while max_tries:
-        try:
-            with requests.get(url, stream=True, timeout=10) as request:
-                if not request:
-                    log.error(f"({request.status_code}) {path}")
-                    return
-
-                cl = int(request.headers.get("Content-Length", "0")) or 10000
-                dw_len = util.float_fmt(cl / 1048576, 2)
-
-                progress(f"{progress_str} | {dw_len}MB {path}")
-
-                now = time.time()
-                with open(path, "wb", buffering=block_size) as file:
-                    for chunk in request.iter_content(chunk_size=block_size):
-                        file.write(chunk)
-                        dw_total += len(chunk)
-
-                        if time.time() - now > 2:
-                            now = time.time()
-                            dw_now = util.float_fmt(dw_total / 1048576, 2)
-                            m = f"{progress_str} | {dw_now}MB / {dw_len}MB {path}"
-                            progress(m, True)
-            return
-        except:
-            log.warning(f"{progress_str} | retry {path}")
-            max_tries -= 1
+def damaged(url, path):
+    # --verify: the server has another size for a file already in the dump
+    if args.render:
+        return False
 
-    log.error(f"{progress_str} | timeout {path}")
+    size = net.remote_size(url)
+    if size is None or size == os.path.getsize(path):
+        return False
 
+    log.warning(f"{os.path.getsize(path)} of {size} bytes, again: {path}")
+    return True
 
-def str_esc(string, url_parse=False):
-    url_regex = r"[-a-zA-Zа-яА-Я0-9@:%_\+.~#?&//=]{2,256}\.[a-zA-Zа-яА-Я0-9]{2,4}\b(\/[-a-zA-Zа-яА-Я0-9@:%_\+.~#?&//=]*)?"
-    html_escape_table = {
-        "&": "&amp;",
-        '"': "&quot;",
-        "'": "&apos;",
-        ">": "&gt;",
-        "<": "&lt;",
-        "\n": "<br/>\n" if url_parse else "\n",
-    }
 
-    string = "".join(html_escape_table.get(c, c) for c in string)
+def str_esc(string, url_parse=False):
+    return util.linkify(string) if url_parse else util.html_esc(string)
 
-    if not url_parse:
-        return string
 
-    replaced = []
-    link_matches = re.finditer(url_regex, string)  # , re.MULTILINE)
-    for match in link_matches:
-        mg = match.group()
-        if mg not in replaced and mg.startswith(("http", "vk.com")):
-            replaced.append(mg)
-            string = string.replace(
-                mg, f'<a href="{mg}" title="{mg}">{util.str_cut(mg, 50)}</a>'
+def thumb_fit(path, src_w, src_h, th_w, th_h):
+    # same size as Image.thumbnail() will make
+    if src_w > th_w or src_h > th_h:
+        path = "photos/thumbnails/th_" + os.path.basename(path)
+        aspect = src_w / src_h
+        if th_w / th_h >= aspect:
+            n = th_h * aspect
+            src_w = min(
+                math.floor(n), math.ceil(n), key=lambda x: abs(aspect - x / th_h)
+            )
+            src_w, src_h = max(src_w, 1), th_h
+        else:
+            n = th_w / aspect
+            src_h = min(
+                math.floor(n), math.ceil(n), key=lambda x: abs(aspect - th_w / (x or 1))
             )
+            src_w, src_h = th_w, max(src_h, 1)
+    else:
+        path = "photos/" + os.path.basename(path)
+
+    return {"path": path, "height": src_h, "width": src_w}
 
-    return string
 
+def obj_key(kind, obj):
+    # vk identity of an attachment, None if the api didn't send one
+    if "owner_id" in obj and "id" in obj:
+        return f"{kind}{obj['owner_id']}_{obj['id']}"
+    return None
 
-def rqst_thumb(path, th_w, th_h):
-    try:
-        img = Image.open(path).convert("RGB")
-    except:
+
+def rqst_object(ctx, key, path, make, force=False):
+    # one copy per archive in the object store, `path` is a link to it
+    ext = os.path.splitext(path)[1]
+    obj = ctx.store.get(key, ext, path, make, force or args.rewrite)
+    if obj:
+        ctx.manifest.put(path, key, sha256=obj.stem)
+    return obj
+
+
+def rqst_thumb(ctx, path, th_w, th_h, key=None):
+    # the size comes from the cache or the file header, pixels are decoded in the pool
+    size = thumbs.size(ctx.path(path))
+    if size is None:
         log.error("corrupted image %s" % path)
         return {"path": "broken", "height": 100, "width": 100}
 
-    src_w, src_h = img.size
-    if src_w > th_w or src_h > th_h:
-        path = "photos/thumbnails/th_" + os.path.basename(path)
-        img.thumbnail((th_w, th_h))
-        src_w, src_h = img.size
-        img.save(path)
-    else:
-        path = "photos/" + os.path.basename(path)
+    thumb = thumb_fit(path, *size, th_w, th_h)
+    if thumb["path"] != path:
+        src, dst = ctx.path(path), ctx.path(thumb["path"])
+        w, h = thumb["width"], thumb["height"]
+        key = key and f"{key}@{w}x{h}"
 
-    return {"path": path, "height": src_h, "width": src_w}
+        def make(p):
+            thumbs.make(src, p, w, h)
+
+        dwq.submit("thumb", dst, rqst_object, ctx, key, dst, make, group=ctx)
+
+    return thumb
+
+
+def rqst_image(ctx, url, path, src_w, src_h, th_w, th_h, key=None):
+    full = ctx.path(path)
+
+    def fetch(p):
+        rqst_file(url, p, ctx.progress_str)
+
+    # the api knows the size, so the page doesn't wait for the download
+    if not (src_w and src_h):
+        if args.rewrite or not ctx.manifest.has(full):
+            rqst_object(ctx, key, full, fetch)
+        return rqst_thumb(ctx, path, th_w, th_h, key)
+
+    thumb = thumb_fit(path, src_w, src_h, th_w, th_h)
+
+    def dw():
+        has = ctx.manifest.has
+        done = has(ctx.path(thumb["path"])) and has(full)
+        force = done and args.verify and damaged(url, full)
+        if done and not args.rewrite and not force:
+            return
+
+        if rqst_object(ctx, key, full, fetch, force) and thumb["path"] != path:
+            w, h = thumb["width"], thumb["height"]
+
+            def make(p):
+                thumbs.make(full, p, w, h)
+
+            tkey = key and f"{key}@{w}x{h}"
+            rqst_object(ctx, tkey, ctx.path(thumb["path"]), make, force)
+
+    dwq.submit("photo", full, dw, group=ctx)
+    return thumb
+
+
+def rqst_file_bg(ctx, kind, url, path, key=None):
+    path = ctx.path(path)
+    if not url or (ctx.manifest.has(path) and not args.rewrite and not args.verify):
+        return
+
+    def fetch(p):
+        rqst_file(url, p, ctx.progress_str)
+
+    def dw():
+        force = ctx.manifest.has(path) and not args.rewrite
+        if force and not damaged(url, path):
+            return
+        rqst_object(ctx, key, path, fetch, force)
+
+    dwq.submit(kind, path, dw, group=ctx)
+
+
+def rqst_media(ctx, kind, key, href, link, make):
+    # the page links the local file right away; if the pool can't make it,
+    # relink() points the pages back to vk once the dialog is done
+    path = ctx.path(href)
+
+    def dw():
+        obj = None
+        try:
+            obj = rqst_object(ctx, key, path, make)
+        finally:
+            if not obj:
+                ctx.missing.append((href, link))
+
+    dwq.submit(kind, path, dw, group=ctx)
+
+
+def rqst_video(ctx, v_id, link, href):
+    # probed and downloaded in the video pool, a private video ends up a vk link
+    key = f"video{v_id}"
+    if not args.rewrite and ctx.store.lookup(key):
+        return rqst_object(ctx, key, ctx.path(href), None)
+
+    def make(p):
+        if videos.probe(v_id, link) is not None:
+            videos.download(v_id, p)
+
+    rqst_media(ctx, "video", key, href, link, make)
+    return True
+
+
+def rqst_music(ctx, obj, href, link):
+    # the url is asked for, and the track downloaded and merged, in the music
+    # pool; an unavailable track ends up a vk link
+    key = obj_key("audio", obj)
+    if key and not args.rewrite and ctx.store.lookup(key):
+        return rqst_object(ctx, key, ctx.path(href), None)
+
+    def make(p):
+        # a page of vk.com, paced with the api calls
+        api.bucket.take()
+        track = vk_audio.get_audio_by_id(obj["owner_id"], obj["id"])
+        if not track or not track.get("url"):
+            return
+
+        r = mu.rqst_multiple(track, os.fspath(p), threads=args.threads)
+        if not r.ok:
+            raise Exception(r.error)
+
+    rqst_media(ctx, "music", key, href, link, make)
+    return True
 
 
 def rqst_photo(input):
@@ -154,73 +338,42 @@ def rqst_photo(input):
     return {"url": photo["url"], "height": photo["height"], "width": photo["width"]}
 
 
-def rqst_user(user_id, save=True):
-    for i in range(len(users)):
-        if users[i]["id"] == user_id:
-            return users[i]
+def rqst_user(ctx, user_id, save=True):
+    if user_id in ctx.users:
+        return ctx.users[user_id]
 
-    if user_id > 0:
-        r = rqst_method("users.get", {"user_ids": user_id, "fields": "photo_200"})[0]
-        user = {
-            "id": user_id,
-            "photo": r["photo_200"],
-            "name": r["first_name"] + " " + r["last_name"],
-        }
-    else:
-        r = rqst_method(
-            "groups.getById",
-            {"group_id": util.str_toplus(user_id), "fields": "photo_200"},
-        )[0]
-        user = {"id": user_id, "photo": r["photo_200"], "name": r["name"]}
+    user = profiles.get(user_id)
 
     if save:
-        rqst_file(user["photo"], "userpics/id%s.jpg" % user_id)
-        users[len(users)] = user
+        rqst_file_bg(ctx, "userpic", user["photo"], "userpics/id%s.jpg" % user_id)
+        ctx.users[user_id] = user
 
     return user
 
 
-def rqst_method(method, values={}):
-    while True:
-        try:
-            r = vk_session.method(method, values)
-            return r
-
-        except Exception as e:
-            e = str(e)
-
-            # invalid login/pass
-            if "[5] User authorization failed:" in e:
-                log.error("autechre error: " + e[31:])
-                sys.exit()
-
-            # non-existing user
-            if "Invalid user id" in e:
-                return None
+def msg_peers(msg):
+    # every id that rqst_message / rqst_message_service will ask for
+    if "action" in msg:
+        yield msg["action"].get("member_id")
 
-            # non-existing group
-            if "group_ids is undefined" in e:
-                return None
+    stack = [msg]
+    while stack:
+        m = stack.pop()
+        yield m.get("from_id")
+        if "reply_message" in m:
+            stack.append(m["reply_message"])
+        stack += m.get("fwd_messages", [])
 
-            # non-existing chat
-            if "no access to this chat" in e:
-                return None
 
-            # idk
-            if "Internal server error" in e:
-                log.warning("internal catched, waiting...   ")
-                time.sleep(100)
-
-            else:
-                log.error(f"execption in '{method}': {e}, values={values}   ")
-                time.sleep(10)
+def rqst_method(method, values={}):
+    return api.method(method, values)
 
 
-def rqst_message_service(input):
+def rqst_message_service(ctx, input):
     goto_link = '<a href="#go_to_message%d" onclick="return GoToMessage(%d)" title="%s" style="color: #70777b">%s</a>'
     url_link = '<a href="%s" style="color: #70777b">%s</a>'
 
-    from_id = rqst_user(input["from_id"])
+    from_id = rqst_user(ctx, input["from_id"])
     from_prefix = "https://vk.com/" + ("id" if from_id["id"] > 0 else "club")
 
     message = ""
@@ -230,46 +383,55 @@ def rqst_message_service(input):
         case "chat_create":
             message = (
                 url_link
-                % (from_prefix + util.str_toplus(from_id["id"]), from_id["name"])
-                + f" создал беседу «{input['action']['text']}»"
+                % (
+                    from_prefix + util.str_toplus(from_id["id"]),
+                    str_esc(from_id["name"]),
+                )
+                + f" создал беседу «{str_esc(input['action']['text'])}»"
             )
 
         case "chat_title_update":
             message = (
                 url_link
-                % (from_prefix + util.str_toplus(from_id["id"]), from_id["name"])
-                + f" изменил название беседы на «{input['action']['text']}»"
+                % (
+                    from_prefix + util.str_toplus(from_id["id"]),
+                    str_esc(from_id["name"]),
+                )
+                + f" изменил название беседы на «{str_esc(input['action']['text'])}»"
             )
 
         case "chat_invite_user_by_link":
             message = (
-                url_link % (from_prefix + str(from_id["id"]), from_id["name"])
+                url_link % (from_prefix + str(from_id["id"]), str_esc(from_id["name"]))
                 + " присоединился к беседе по ссылке"
             )
 
         case "chat_photo_update":
-            rqst_file(
+            rqst_file_bg(
+                ctx,
+                "userpic",
                 rqst_photo(input["attachments"][0]["photo"])["url"],
                 f"userpics/up{input['conversation_message_id']}.jpg",
             )
 
             message = (
-                f"{url_link % (from_prefix + util.str_toplus(from_id['id']), from_id['name'])} обновил фотографию беседы\n"
-                f'<div class="userpic_wrap">'
+                f"{url_link % (from_prefix + util.str_toplus(from_id['id']), str_esc(from_id['name']))} обновил фотографию беседы\n"
+                f'<div class="userpic_wrap">\n'
                 f'    <a class="userpic_link" href="userpics/up{input["conversation_message_id"]}.jpg">\n'
-                f'        <img class="userpic" src="userpics/up{input["conversation_message_id"]}.jpg" style="width: 60px; height: 60px">'
-                f"    </a>"
-                f"</div>\n"
+                f'        <img class="userpic" src="userpics/up{input["conversation_message_id"]}.jpg" style="width: 60px; height: 60px" />\n'
+                f"    </a>\n"
+                f"</div>"
             )
 
         case "chat_photo_remove":
-            message = f"{url_link % (from_prefix + util.str_toplus(from_id['id']), from_id['name'])} удалил фотографию беседы\n"
+            message = f"{url_link % (from_prefix + util.str_toplus(from_id['id']), str_esc(from_id['name']))} удалил фотографию беседы"
 
         case "chat_pin_message" | "chat_unpin_message":
             prefix = " закрепил " if TYPE == "chat_pin_message" else " открепил "
-            member_id = rqst_user(input["action"]["member_id"])
+            member_id = rqst_user(ctx, input["action"]["member_id"])
             message = (
-                url_link % (from_prefix + str(member_id["id"]), member_id["name"])
+                url_link
+                % (from_prefix + str(member_id["id"]), str_esc(member_id["name"]))
                 + prefix
             )
 
@@ -277,8 +439,8 @@ def rqst_message_service(input):
                 message += "сообщение: " + goto_link % (
                     input["action"]["conversation_message_id"],
                     input["action"]["conversation_message_id"],
-                    input["action"]["message"],
-                    f"«{input['action']['message']}»",
+                    str_esc(input["action"]["message"]),
+                    f"«{str_esc(input['action']['message'])}»",
                 )
             else:
                 message += goto_link % (
@@ -308,38 +470,40 @@ def rqst_message_service(input):
             if input["from_id"] == input["action"]["member_id"]:
                 message = (
                     url_link
-                    % (us_prefix + util.str_toplus(from_id["id"]), from_id["name"])
+                    % (
+                        us_prefix + util.str_toplus(from_id["id"]),
+                        str_esc(from_id["name"]),
+                    )
                     + self_prefix
                 )
             else:
-                passive = rqst_user(input["action"]["member_id"])
+                passive = rqst_user(ctx, input["action"]["member_id"])
                 message = (
                     url_link
-                    % (us_prefix + util.str_toplus(from_id["id"]), from_id["name"])
+                    % (
+                        us_prefix + util.str_toplus(from_id["id"]),
+                        str_esc(from_id["name"]),
+                    )
                     + other_prefix
                     + url_link
-                    % (us_postfix + util.str_toplus(passive["id"]), passive["name"])
+                    % (
+                        us_postfix + util.str_toplus(passive["id"]),
+                        str_esc(passive["name"]),
+                    )
                 )
 
         case _:
             log.error(f"missing_service: {input}")
 
-    return f'\n<div class="message service" id="message{input["id"]}"><div class="body details">\n    {message}</div>\n</div>\n'
+    return srv_blank % (input["id"], indent(message, 2))
 
 
-def rqst_attachments(input):
+def rqst_attachments(ctx, input):
     sw_joined = False
     pre_attachments = post_attachments = ""
 
-    data_blank = (
-        "%s\n"
-        '   <div class="fill pull_left"></div>\n'
-        '   <div class="body">\n'
-        '       <div class="title bold">%s</div>\n'
-        '       <div class="status details">%s</div>\n'
-        "   </div>"
-        "</a>\n"
-    )
+    def data(a_tag, title, status):
+        return data_blank % (a_tag, str_esc(str(title)), str_esc(str(status)))
 
     human_date = datetime.fromtimestamp(input["date"]).strftime("%y-%m-%d_%H-%M-%S")
 
@@ -353,9 +517,8 @@ def rqst_attachments(input):
         if "place" in input["geo"]:
             html_details = "%s (%s)" % (input["geo"]["place"]["title"], html_details)
 
-        pre_attachments = '<div class="media_wrap clearfix">\n%s</div>\n' % (
-            data_blank
-            % (
+        pre_attachments = media_blank % indent(
+            data(
                 '<a class="media clearfix pull_left block_link media_location">',
                 "Местоположение",
                 html_details,
@@ -366,10 +529,12 @@ def rqst_attachments(input):
         a = input["attachments"][i]
         TYPE = a["type"]
 
-        data_fragment = "missing_attachment = %s" % a
+        data_fragment = str_esc("missing_attachment = %s" % a) + "\n"
         json_fragment = ""
         if not args.nojson:
-            json_fragment = f'title="{str_esc(json.dumps(a, indent=10, ensure_ascii=False, sort_keys=True))}"'
+            # index in the page sidecar, see PageAttachments() in script.js
+            json_fragment = f'data-att="{ctx.msg_id}/{len(ctx.att)}"'
+            ctx.att.append(a)
 
         match TYPE:
             case "video":
@@ -382,41 +547,27 @@ def rqst_attachments(input):
                     if args.novideo:
                         raise StopIteration
 
-                    if os.path.exists(href):
-                        if not args.rewrite:
-                            raise StopIteration
-                        util.delete(href)
-
-                    opts = {
-                        "quiet": not args.verbose,
-                        "verbose": False,
-                        "outtmpl": href,
-                        "format": "best",
-                        "extractor_retries": 2,
-                        "fragment_retries": 2,
-                        "socket_timeout": 20,
-                        "retries": 2,
-                        "cookiefile": io.StringIO(vk_cookies),
-                    }
-
-                    # byedpi
-                    # opts['proxy']: "socks5://localhost:1080"
-
-                    with yt_dlp.YoutubeDL(opts) as ydl:
-                        ydl.download([link])
+                    if ctx.manifest.has(ctx.path(href)) and not args.rewrite:
+                        raise StopIteration
+
+                    if args.render:
+                        raise Exception(href)
+
+                    if not rqst_video(ctx, v_id, link, href):
+                        raise Exception(href)
 
                     if args.verbose:
-                        log.trace(f"{progress_str} | {href}")
+                        log.trace(f"{ctx.progress_str} | {href}")
 
                 except StopIteration:
                     pass
 
                 except:
                     if args.verbose:
-                        log.warning(f"{progress_str} | {href}")
+                        log.warning(f"{ctx.progress_str} | {href}")
                     href = link
 
-                data_fragment = data_blank % (
+                data_fragment = data(
                     f'<a class="media clearfix pull_left block_link media_video" {json_fragment} href="{href}">',
                     f"{a['video']['title']}",
                     f"{timedelta(seconds=int(a['video']['duration']))} | {a['video']['owner_id']}_{a['video']['id']}",
@@ -433,29 +584,31 @@ def rqst_attachments(input):
                 )
                 audio_name = util.escut(audio_name)
 
+                link = (
+                    f"https://m.vk.com/audio{a['audio']['owner_id']}_{a['audio']['id']}"
+                )
                 try:
                     href = f"music/{audio_name}.mp3"
                     if args.nomusic:
                         raise Exception()
 
-                    if os.path.exists(href):
-                        if not args.rewrite:
-                            raise StopIteration
-                        util.delete(href)
+                    if ctx.manifest.has(ctx.path(href)) and not args.rewrite:
+                        raise StopIteration
 
-                    audio = vk_audio.get_audio_by_id(
-                        a["audio"]["owner_id"], a["audio"]["id"]
-                    )
-                    mu.rqst_multiple(audio, href)
+                    if args.render:
+                        raise Exception(href)
+
+                    if not rqst_music(ctx, a["audio"], href, link):
+                        raise Exception(href)
 
                 except StopIteration:
                     if args.verbose:
-                        log.info(f"{progress_str} | {href}")
+                        log.info(f"{ctx.progress_str} | {href}")
                     pass
                 except:
-                    href = f"https://m.vk.com/audio{a['audio']['owner_id']}_{a['audio']['id']}"
+                    href = link
 
-                data_fragment = data_blank % (
+                data_fragment = data(
                     f'<a class="media clearfix pull_left block_link media_audio_file" {json_fragment} href="{href}">',
                     audio_name,
                     f"{timedelta(seconds=int(a['audio']['duration']))} | {a['audio']['owner_id']}_{a['audio']['id']} ",
@@ -463,35 +616,35 @@ def rqst_attachments(input):
 
             case "wall":
                 href = f"https://vk.com/wall{a['wall']['to_id']}_{a['wall']['id']}"
-                data_fragment = data_blank % (
+                data_fragment = data(
                     f'<a class="media clearfix pull_left block_link media_game" {json_fragment} href="{href}">',
                     "Запись",
                     href,
                 )
 
             case "poll":
-                data_fragment = data_blank % (
+                data_fragment = data(
                     f'<a class="media clearfix pull_left block_link media_game" {json_fragment} href="https://vk.com/poll{a["poll"]["owner_id"]}_{a["poll"]["id"]}">',
                     "Опрос",
                     f"id{a['poll']['question']}",
                 )
 
             case "gift":
-                data_fragment = data_blank % (
+                data_fragment = data(
                     f'<a class="media clearfix pull_left block_link media_game" {json_fragment} href="{a["gift"]["thumb_256"]}">',
                     "Подарок",
                     f"id{a['gift']['id']}",
                 )
 
             case "link":
-                data_fragment = data_blank % (
+                data_fragment = data(
                     f'<a class="media clearfix pull_left block_link media_game" {json_fragment} href="{a["link"]["url"]}">',
                     a["link"]["title"],
                     a["link"]["caption"] if "caption" in a["link"] else "",
                 )
 
             case "market":
-                data_fragment = data_blank % (
+                data_fragment = data(
                     f'<a class="media clearfix pull_left block_link media_invoice" {json_fragment} href="https://vk.com/market{a["market"]["owner_id"]}_{a["market"]["id"]}">',
                     a["market"]["title"],
                     a["market"]["price"]["text"],
@@ -505,7 +658,7 @@ def rqst_attachments(input):
                     html_title = "Комментарий к записи"
                     href = f"https://vk.com/wall{a['wall_reply']['owner_id']}_{a['wall_reply']['post_id']}?reply={a['wall_reply']['id']}"
 
-                data_fragment = data_blank % (
+                data_fragment = data(
                     f'<a class="media clearfix pull_left block_link media_game" {json_fragment} href="{href}">',
                     html_title,
                     href,
@@ -521,9 +674,11 @@ def rqst_attachments(input):
                     href = a["doc"]["url"]
                 else:
                     href = f"docs/{namefile}-{i}-{input['conversation_message_id']}_{human_date}.{a['doc']['ext']}"
-                    rqst_file(a["doc"]["url"], href)
+                    rqst_file_bg(
+                        ctx, "doc", a["doc"]["url"], href, obj_key("doc", a["doc"])
+                    )
 
-                data_fragment = data_blank % (
+                data_fragment = data(
                     f'<a class="media clearfix pull_left block_link media_file" {json_fragment} href="{href}">',
                     namefile + "." + a["doc"]["ext"],
                     f"{util.sizeof_fmt(a['doc']['size'])} ({a['doc']['owner_id']}_{a['doc']['id']})",
@@ -545,7 +700,7 @@ def rqst_attachments(input):
                     case "reached":
                         html_details = f"Завершен ({timedelta(seconds=int(a['call']['duration']))})"
 
-                data_fragment = data_blank % (
+                data_fragment = data(
                     f'<a class="media clearfix pull_left block_link media_call" {json_fragment}>',
                     html_title,
                     html_details,
@@ -553,19 +708,28 @@ def rqst_attachments(input):
 
             case "graffiti":
                 if args.nograffiti:
-                    data_fragment = data_blank % (
+                    data_fragment = data(
                         f'<a class="media clearfix pull_left block_link media_photo" {json_fragment} href="{a["graffiti"]["url"]}">',
                         "Граффити",
                         f"{a['graffiti']['height']}x{a['graffiti']['width']}",
                     )
                 else:
                     namefile = f"graffiti-{input['conversation_message_id']}-{i}_{human_date}.jpg"
-                    rqst_file(a["graffiti"]["url"], "photos/" + namefile)
-                    thumb = rqst_thumb("photos/" + namefile, 350, 300)
+                    thumb = rqst_image(
+                        ctx,
+                        a["graffiti"]["url"],
+                        "photos/" + namefile,
+                        a["graffiti"].get("width"),
+                        a["graffiti"].get("height"),
+                        350,
+                        300,
+                        obj_key("graffiti", a["graffiti"]),
+                    )
 
                     data_fragment = (
                         f'<a class="photo_wrap clearfix pull_left" href="photos/{namefile}">\n'
-                        f'<img class="photo" src="{thumb["path"]}" style="width: {thumb["width"]}px; height: {thumb["height"]}px"/></a>'
+                        f'    <img class="photo" src="{thumb["path"]}" style="width: {thumb["width"]}px; height: {thumb["height"]}px" />\n'
+                        "</a>\n"
                     )
 
             case "audio_message":
@@ -573,9 +737,15 @@ def rqst_attachments(input):
                     href = a["audio_message"]["link_ogg"]
                 else:
                     href = f"voice_messages/audio-{i}-{input['conversation_message_id']}_{human_date}.ogg"
-                    rqst_file(a["audio_message"]["link_ogg"], href)
+                    rqst_file_bg(
+                        ctx,
+                        "voice",
+                        a["audio_message"]["link_ogg"],
+                        href,
+                        obj_key("voice", a["audio_message"]),
+                    )
 
-                data_fragment = data_blank % (
+                data_fragment = data(
                     f'<a class="media clearfix pull_left block_link media_voice_message" {json_fragment} href="{href}">',
                     "Голосовое сообщение",
                     timedelta(seconds=int(a["audio_message"]["duration"])),
@@ -583,27 +753,31 @@ def rqst_attachments(input):
 
             case "sticker":
                 if args.nosticker:
-                    data_fragment = data_blank % (
+                    data_fragment = data(
                         f'<a class="media clearfix pull_left block_link media_photo" {json_fragment} href="{a["sticker"]["images"][1]["url"]}">',
                         "Стикер",
                         f"id{a['sticker']['sticker_id']}",
                     )
                 else:
-                    rqst_file(
+                    rqst_file_bg(
+                        ctx,
+                        "sticker",
                         a["sticker"]["images"][1]["url"],
                         f"userpics/st{a['sticker']['sticker_id']}.jpg",
+                        f"sticker{a['sticker']['sticker_id']}",
                     )
 
                     data_fragment = (
                         f'<a class="sticker_wrap clearfix pull_left" href="userpics/st{a["sticker"]["sticker_id"]}.jpg">\n'
-                        f'<img class="sticker" src="userpics/st{a["sticker"]["sticker_id"]}.jpg" style="width: 128px; height: 128px"/></a>'
+                        f'    <img class="sticker" src="userpics/st{a["sticker"]["sticker_id"]}.jpg" style="width: 128px; height: 128px" />\n'
+                        "</a>\n"
                     )
 
             case "photo":
                 p = rqst_photo(a["photo"])
 
                 if args.nophoto:
-                    data_fragment = data_blank % (
+                    data_fragment = data(
                         f'<a class="media clearfix pull_left block_link media_photo" {json_fragment} href="{p["url"]}">',
                         "Фото",
                         f"{p['height']}x{p['width']}",
@@ -615,43 +789,167 @@ def rqst_attachments(input):
                     namefile = (
                         f"ph-{input['conversation_message_id']}-{i}_{photo_date}.jpg"
                     )
-                    rqst_file(p["url"], "photos/" + namefile)
-                    thumb = rqst_thumb("photos/" + namefile, 350, 280)
+                    thumb = rqst_image(
+                        ctx,
+                        p["url"],
+                        "photos/" + namefile,
+                        p["width"],
+                        p["height"],
+                        350,
+                        280,
+                        obj_key("photo", a["photo"]),
+                    )
 
                     data_fragment = (
                         f'<a class="photo_wrap clearfix pull_left" href="photos/{namefile}">\n'
-                        f'<img class="photo" src="{thumb["path"]}" style="width: {thumb["width"]}px; height: {thumb["height"]}px"/></a>'
+                        f'    <img class="photo" src="{thumb["path"]}" style="width: {thumb["width"]}px; height: {thumb["height"]}px" />\n'
+                        "</a>\n"
                     )
 
             case _:
                 log.error(f"missing_attachment: {a}")
 
         if sw_joined:
-            post_attachments += (
-                f'<div class="message default clearfix joined">\n'
-                f'    <div class="body">{data_fragment}\n'
-                f"    </div>\n"
-                f"</div>\n"
-            )
+            post_attachments += joined_blank % indent(data_fragment, 2)
         else:
-            pre_attachments = (
-                f'<div class="media_wrap clearfix">\n{data_fragment}</div>\n'
-            )
+            pre_attachments = media_blank % indent(data_fragment)
             sw_joined = True
 
     return (pre_attachments, post_attachments)
 
 
-def rqst_message(input, forwarded=False):
-    global prev_id, prev_date
-    fwd_messages = ""
-    from_id = rqst_user(input["from_id"])
+def quote_children(msg):
+    # reply and forwards of a message, a ready fragment if the reply has no id
+    quotes = []
+    if "reply_message" in msg:
+        if "conversation_message_id" in msg["reply_message"]:
+            quotes.append(msg["reply_message"])
+        else:
+            quotes.append(
+                f'<div title="{str_esc(str(msg["reply_message"]))}" class="reply_to details">Нет id пересланного сообщения</div>\n'
+            )
+
+    return quotes + msg.get("fwd_messages", [])
+
+
+def quote_keys(root):
+    # a quote is the same only if its own quotes are, so keys go bottom-up;
+    # quotes without an id anywhere below are not cached
+    keys = {}  # id(msg) => key or None
+    stack = [(root, 0, False)]
+
+    while stack:
+        msg, depth, seen = stack.pop()
+        quotes = quote_children(msg)
+
+        if not seen:
+            stack.append((msg, depth, True))
+            stack += [(q, depth + 1, False) for q in quotes if isinstance(q, dict)]
+            continue
+
+        inner = [keys[id(q)] if isinstance(q, dict) else None for q in quotes]
+        if depth and msg.get("conversation_message_id") and all(inner):
+            keys[id(msg)] = (
+                msg.get("peer_id"),
+                msg["conversation_message_id"],
+                msg["from_id"],
+                msg["date"],
+                msg.get("update_time"),
+                msg.get("text"),
+                len(msg.get("attachments", [])),
+                depth,
+                tuple(inner),
+            )
+        else:
+            keys[id(msg)] = None
+
+    return keys
+
+
+_att_ref = re.compile(r'data-att="([^"/]+)/(\d+)"')
+
+
+def quote_store(ctx, key, html, base):
+    # attachment refs are made relative, another message will have other ones
+    att = ctx.att[base:]
+    if att:
+        html = _att_ref.sub(lambda m: f'data-att="@/{int(m[2]) - base}"', html)
+    ctx.quotes.put(key, (html, att))
+
+
+def quote_load(ctx, entry):
+    html, att = entry
+    if not att:
+        return html
+
+    base = len(ctx.att)
+    ctx.att.extend(att)
+    return _att_ref.sub(lambda m: f'data-att="{ctx.msg_id}/{int(m[2]) + base}"', html)
+
+
+def quote_collapsed(msg):
+    n, stack = 0, [msg]
+    while stack:
+        quotes = quote_children(stack.pop())
+        n += len(quotes)
+        stack += [q for q in quotes if isinstance(q, dict)]
+
+    return f'<div class="reply_to details">И ещё {n} вложенных сообщений</div>\n'
+
+
+def rqst_quotes(ctx, root):
+    # replies and forwards of `root`, deepest first without recursion; a quote
+    # already rendered in this dialog comes from the cache, the chain is cut
+    # at --fwd-depth
+    keys = quote_keys(root)
+    done = {}  # id(msg) => html
+    stack = [(root, 0, None, None)]
+
+    while stack:
+        msg, depth, base, key = stack.pop()
+        quotes = quote_children(msg)
+
+        # first visit: the quotes of the message go first
+        if base is None:
+            key = keys[id(msg)]
+            if key and (entry := ctx.quotes.get(key)):
+                done[id(msg)] = quote_load(ctx, entry)
+                continue
+
+            stack.append((msg, depth, len(ctx.att), key))
+            if depth < args.fwd_depth:
+                for q in reversed(quotes):
+                    if isinstance(q, dict):
+                        stack.append((q, depth + 1, None, None))
+            continue
+
+        if depth >= args.fwd_depth and quotes:
+            fwd = quote_collapsed(msg)
+        else:
+            fwd = "".join(q if isinstance(q, str) else done[id(q)] for q in quotes)
+
+        if not depth:
+            return fwd
+
+        html = rqst_message(ctx, msg, True, fwd)
+        if key:
+            quote_store(ctx, key, html, base)
+        done[id(msg)] = html
+
+
+def rqst_message(ctx, input, forwarded=False, fwd_messages=None):
+    if fwd_messages is None:
+        fwd_messages = rqst_quotes(ctx, input)
+
+    from_id = rqst_user(ctx, input["from_id"])
 
     # url selection
     if from_id["id"] > 0:
-        sender = f'<a href="https://vk.com/id{from_id["id"]}">{from_id["name"]}</a>'
+        sender = (
+            f'<a href="https://vk.com/id{from_id["id"]}">{str_esc(from_id["name"])}</a>'
+        )
     else:
-        sender = f'<a href="https://vk.com/club{util.str_toplus(from_id["id"])}">{from_id["name"]}</a>'
+        sender = f'<a href="https://vk.com/club{util.str_toplus(from_id["id"])}">{str_esc(from_id["name"])}</a>'
 
     # message sending/changing time
     date = datetime.fromtimestamp(input["date"]).strftime("%d/%m/%y %H:%M:%S")
@@ -662,29 +960,18 @@ def rqst_message(input, forwarded=False):
     if "conversation_message_id" not in input:
         input["conversation_message_id"] = random.randint(-100, -1)
 
-    # reply message
-    if "reply_message" in input:
-        if "conversation_message_id" in input["reply_message"]:
-            fwd_messages += rqst_message(input["reply_message"], True)
-        else:
-            fwd_messages += f'<div title="{input["reply_message"]}" class="reply_to details">Нет id пересланного сообщения</div>\n'
-
-    # forwarded messages
-    if "fwd_messages" in input:
-        for i in input["fwd_messages"]:
-            fwd_messages += rqst_message(i, True)
-
     # requesting attachments
-    pre_attachments, post_attachments = rqst_attachments(input)
+    pre_attachments, post_attachments = rqst_attachments(ctx, input)
 
     # blank selection
+    level = 1 if forwarded else 2
     if forwarded:
         blank = fwd_blank
-    elif prev_id == from_id["id"] and input["date"] - prev_date < 120:
+    elif ctx.prev_id == from_id["id"] and input["date"] - ctx.prev_date < 120:
         blank = jnd_blank
     else:
-        prev_date = input["date"]
-        prev_id = from_id["id"]
+        ctx.prev_date = input["date"]
+        ctx.prev_id = from_id["id"]
         blank = def_blank
 
     return blank % (
@@ -693,70 +980,216 @@ def rqst_message(input, forwarded=False):
         from_id["id"],
         sender if forwarded else date,
         date if forwarded else sender,
-        fwd_messages,
-        str_esc(input["text"], True),
-        '<div class="message default"></div>\n'
-        if input["text"] and forwarded and "fwd_messages" not in input
-        else "" + pre_attachments,
+        indent(fwd_messages, level),
+        indent(str_esc(input["text"], True), level + 1),
+        indent(
+            '<div class="message default"></div>\n'
+            if input["text"] and forwarded and "fwd_messages" not in input
+            else "" + pre_attachments,
+            level,
+        ),
         post_attachments,
     )
 
 
-def makehtml(filename, page, count, target, chat, const_offset_count):
-    global progress_str, items_done, offset_count
-    for i in range(args.pagenum):
-        # empty check
-        while True:
-            chunk = rqst_method(
-                "messages.getHistory",
+def rqst_history(ctx, after=0):
+    target = ctx.target
+
+    # the oldest chunk, unless it goes on from a previous dump
+    if not after:
+        items = rqst_method(
+            "messages.getHistory", {"peer_id": target, "count": 200, "rev": 1}
+        )["items"]
+        if not items:
+            return
+
+        items = sorted(items, key=lambda m: m["id"])
+        yield items
+        after = items[-1]["id"]
+
+    # then 200 messages newer than the last one seen, up to 25 getHistory per
+    # execute; new messages can't shift a message id like they shift offsets
+    limit = max(1, min(args.execute, 25))
+    pages = limit
+
+    while True:
+        r = [None]
+
+        if pages > 1:
+            r = rqst_method(
+                "execute",
                 {
+                    "code": HISTORY_CODE,
                     "peer_id": target,
-                    "count": 200,
-                    "extended": 1,
-                    "offset": offset_count * 200,
+                    "start_message_id": after,
+                    "pages": pages,
                 },
             )
-            if chunk["items"] or offset_count < 0:
+
+            if r is None:
+                # response size is too big, halved until it fits
+                pages = max(1, pages // 2)
+                log.warning(f"{ctx.progress_str} | execute: {pages} pages per call")
+                continue
+
+            if r is False:
+                # any other runtime error, this round goes without execute
+                log.warning(f"{ctx.progress_str} | execute failed, one page")
+                r = [None]
+            else:
+                # grown back one by one, the size of a page changes along the dialog
+                pages = min(limit, pages + 1)
+        else:
+            # a single page fitted, execute is tried again
+            pages = min(limit, 2)
+
+        for items in r:
+            # failed inside execute or no execute at all
+            failed = not isinstance(items, list)
+            if failed:
+                items = rqst_method(
+                    "messages.getHistory",
+                    {
+                        "peer_id": target,
+                        "start_message_id": after,
+                        "offset": -200,
+                        "count": 200,
+                    },
+                )["items"]
+
+            # the last chunk also brings older messages along
+            items = sorted((m for m in items if m["id"] > after), key=lambda m: m["id"])
+            if not items:
+                return
+
+            yield items
+            after = items[-1]["id"]
+
+            # the rest of execute went on from a chunk that is not there
+            if failed:
                 break
 
-            offset_count -= 1
 
-        for msg in reversed(chunk["items"]):
-            items_done += 1
+def save_msg(ctx, msg):
+    out = ctx.out
+    if out["raw"]:
+        out["raw"].write(json.dumps(msg, ensure_ascii=False))
 
-            # html msg
-            util.append(
-                filename,
-                rqst_message_service(msg) if "action" in msg else rqst_message(msg),
-            )
+    if out["pretty"]:
+        s = json.dumps(msg, indent=4, ensure_ascii=False).replace("\n", "\n    ")
+        out["pretty"].write(("\n    " if ctx.items_done == 1 else ",\n    ") + s, "")
+
+    if msg.get("text"):
+        name = rqst_user(ctx, msg["from_id"])["name"]
+        text = msg["text"].replace("\n", "\n" + " " * (len(name) + 3))
+        out["irc"].write(f"<{name}> {text}")
+
+
+def open_page(ctx, page, resume=False):
+    filename = ctx.path("messages%s.html" % page)
+    sidecar = ctx.path("messages%s.attachments.js" % page)
+    mode = "a" if resume else "w"
+
+    # continuing the last page of the previous run
+    if resume:
+        os.truncate(filename, ctx.ckpt["body_end"])
+        if os.path.exists(sidecar):
+            os.truncate(sidecar, ctx.ckpt.get("att_end", 0))
+
+    # attachments json, loaded by script.js only when it's asked for
+    ctx.out["att"] = None if args.nojson else util.Sink(sidecar, mode)
+
+    if resume:
+        ctx.out["html"] = util.Sink(filename, "a")
+        return
 
-            # json msg
-            s = ",%s"
-            if not os.path.isfile("result.json"):
-                util.append("result.json", "[")
-                s = "%s"
+    ctx.out["html"] = util.Sink(filename)
+    ctx.out["html"].write(ctx.header, "")
 
-            util.append("result.json", s % json.dumps(msg, ensure_ascii=False))
+    if page > 1:
+        a = page_blank % (page - 1, "Предыдущая страница", page - 1)
+        ctx.out["html"].write(a, "")
+
+
+def close_page(ctx, page, last=False):
+    html = ctx.out["html"]
+
+    # where the next run will continue this page
+    body_end = html.tell()
+    if ctx.out["att"]:
+        ctx.ckpt["att_end"] = ctx.out["att"].tell()
+        ctx.out["att"].close()
+
+    if not last:
+        a = page_blank % (page + 1, "Cледующая страница", page + 1)
+        html.write(a, "")
+
+    html.write(eof_blank)
+    html.close()
+    return body_end
+
+
+def makehtml(ctx, history, count):
+    ckpt = ctx.ckpt
+    for chunk in history:
+        # one users.get / groups.getById for the whole chunk
+        profiles.resolve(p for msg in chunk for p in msg_peers(msg))
+
+        for msg in chunk:
+            # page is full
+            if ckpt["page_items"] >= ckpt["pagenum"]:
+                close_page(ctx, ckpt["page"])
+                ckpt["page"] += 1
+                ckpt["page_items"] = 0
+                open_page(ctx, ckpt["page"])
+
+            ctx.items_done += 1
+            ckpt["page_items"] += 1
+            ckpt["last_id"] = max(ckpt["last_id"], msg["id"])
+
+            # html msg
+            ctx.msg_id, ctx.att = msg["id"], []
+            with stages.stage("render"):
+                if "action" in msg:
+                    html = rqst_message_service(ctx, msg)
+                else:
+                    html = rqst_message(ctx, msg)
+            ctx.out["html"].write(indent(html, 4), "")
+
+            # attachments json for the page sidecar
+            if ctx.att:
+                att = json.dumps(ctx.att, ensure_ascii=False, sort_keys=True)
+                ctx.out["att"].write(f"PageAttachments({ctx.msg_id}, {att});")
+
+            # the anchor the page has for it
+            if ctx.index:
+                anchor = (
+                    msg["id"] if "action" in msg else msg["conversation_message_id"]
+                )
+                name = rqst_user(ctx, msg["from_id"])["name"]
+                with stages.stage("search"):
+                    ctx.index.add(
+                        ckpt["page"], ckpt["page_items"] - 1, anchor, msg, name
+                    )
+
+            # json / irc msg
+            save_msg(ctx, msg)
 
             # status stuff
-            progress_str = f"[{util.escut(chat['title'], 20)}]"
-            progress_str += f" {util.float_fmt((items_done) / count * 100, 1)}%"
-            progress_str += f" {items_done}/{count}"
-            progress_str += f" u{len(users)}"
-            progress_str += f" pg{page + 1}/{count // (200 * args.pagenum) + 1}"
-            progress_str += f" pgch{i + 1}/{args.pagenum}"
-            progress_str += (
-                f" allch{const_offset_count - offset_count}/{const_offset_count}"
+            done = ctx.items_done
+            ctx.progress_str = (
+                f"[{util.escut(ctx.title, 20)}]"
+                f" {util.float_fmt(done / max(count, 1) * 100, 1)}%"
+                f" {done}/{count}"
+                f" u{len(ctx.users)}"
+                f" pg{ckpt['page']}"
             )
 
-            progress(progress_str)
-
-        offset_count -= 1
+            progress(ctx.progress_str)
 
 
 def makedump(target):
-    global items_done, offset_count, progress_str
-
+    ctx = Dump(target)
     start_time = time.time()
     me = rqst_method("users.get")[0]
 
@@ -777,7 +1210,7 @@ def makedump(target):
             else "https://vk.com/images/deactivated_200.png",
         }
 
-        admin = rqst_user(r["admin_id"], False)
+        admin = rqst_user(ctx, r["admin_id"], False)
 
         info = (
             f"Название: {chat['title']}\n"
@@ -788,7 +1221,7 @@ def makedump(target):
         )
 
     else:
-        r = rqst_user(target, False)
+        r = rqst_user(ctx, target, False)
         chat = {"title": r["name"], "photo": r["photo"]}
 
         if r is None:
@@ -801,12 +1234,70 @@ def makedump(target):
             f"Сидящий: {me['first_name']} {me['last_name']} ({me['id']})"
         )
 
-    # directory preparation
     d = util.escut(chat["title"], 40)
-    work_dir = "%s (%s)" % (d, target)
+    ctx.title = chat["title"]
+    ctx.root = os.path.abspath("%s (%s)" % (d, target))
+
+    # html page creation
+    count = rqst_method("messages.getHistory", {"peer_id": target, "count": 0})["count"]
+
+    ckpt = None
+    if args.update and os.path.isfile(ctx.path("checkpoint.json")):
+        with open(ctx.path("checkpoint.json"), encoding="utf-8") as f:
+            ckpt = json.load(f)
+
+    if ckpt and ckpt["last_id"]:
+        history = rqst_history(ctx, ckpt["last_id"])
+
+        # nothing new => nothing is touched
+        first = next(history, None)
+        if first is None:
+            log.success(f"{chat['title']} is up to date")
+            return
+
+        history = itertools.chain([first], history)
+    else:
+        history = rqst_history(ctx)
+        ckpt = new_ckpt("result.ndjson" + COMPRESS[args.compress])
+
+    ckpt["chat"] = {**chat, "info": info}
+    ctx.ckpt = ckpt
+    ctx.store = store
+    ctx.manifest = manifest
+    writedump(ctx, history, count)
 
-    shutil.copytree("blank", work_dir, dirs_exist_ok=True)
-    os.chdir(work_dir)
+    end_time = util.float_fmt(time.time() - start_time, 0)
+    end_time = timedelta(seconds=int(end_time))
+
+    log.success(f"{chat['title']} finished in {end_time} ")
+
+
+def new_ckpt(raw):
+    return {
+        "last_id": 0,
+        "count": 0,
+        "page": 1,
+        "page_items": 0,
+        "pagenum": args.pagenum,
+        "body_end": 0,
+        "raw": raw,
+        "sizes": {"pretty": 0} if args.pretty else {},
+        "prev_id": 0,
+        "prev_date": 0,
+        "users": [],
+    }
+
+
+def writedump(ctx, history, count, save_raw=True):
+    # pages, sidecars, irc / json files and the checkpoint of one dialog
+    ckpt = ctx.ckpt
+    chat = ckpt["chat"]
+    resume = ckpt["count"] > 0
+
+    # directory preparation
+    shutil.copytree(
+        "blank", ctx.root, dirs_exist_ok=True, copy_function=util.copy_changed
+    )
 
     for DIR in [
         "voice_messages",
@@ -816,71 +1307,253 @@ def makedump(target):
         "docs",
         "userpics",
     ]:
-        os.makedirs(DIR, exist_ok=True)
+        os.makedirs(ctx.path(DIR), exist_ok=True)
 
     # chat pfp
-    rqst_file(chat["photo"], "userpics/main.jpg")
+    rqst_file_bg(ctx, "userpic", chat["photo"], "userpics/main.jpg")
 
-    # html page creation
-    count = rqst_method("messages.getHistory", {"peer_id": target, "count": 0})["count"]
+    files = {
+        "raw": ctx.path(ckpt["raw"]),
+        "irc": ctx.path("irc.txt"),
+        "pretty": ctx.path("result.json"),
+    }
+    mode = "a" if resume else "w"
 
-    const_offset_count = offset_count = count // 200 + 1
-    page_count = count // (200 * args.pagenum) + 1
+    if resume:
+        # dropping whatever an interrupted run left after the checkpoint
+        for k, size in ckpt["sizes"].items():
+            os.truncate(files[k], size)
 
-    for page in range(page_count):
-        filename = "messages%s.html" % (page + 1)
-        pathlib.Path(filename).unlink(missing_ok=True)
+        ctx.items_done = ckpt["count"]
+        ctx.prev_id, ctx.prev_date = ckpt["prev_id"], ckpt["prev_date"]
 
-        # html header
-        util.append(
-            filename, mainfile % (str_esc(chat["title"]), info, str_esc(chat["title"]))
-        )
+        profiles.resolve(ckpt["users"])
+        ctx.users.update((u, profiles.get(u)) for u in ckpt["users"])
 
-        # to the previous page
-        if page:
-            a = f'\n<a class="pagination block_link" href="messages{page}.html">Предыдущая страница ( {page} / {page_count} )</a>\n'
-            util.append(filename, a)
+    out = ctx.out = {
+        "raw": util.Sink(files["raw"], mode) if save_raw else None,
+        "irc": util.Sink(files["irc"], mode),
+        "pretty": util.Sink(files["pretty"], mode)
+        if "pretty" in ckpt["sizes"]
+        else None,
+    }
+
+    if out["pretty"] and not resume:
+        out["pretty"].write("[", "")
+
+    # search/ with token shards, continued like the pages
+    index_dir = ctx.path("search")
+    if args.nosearch:
+        ckpt.pop("search", None)
+        shutil.rmtree(index_dir, ignore_errors=True)
+    elif not resume:
+        ckpt["search"] = {"shards": search.shards_for(count)}
+        ctx.index = search.Index(index_dir, ckpt["search"]["shards"])
+    elif "search" in ckpt:
+        at = (ckpt["page"], ckpt["page_items"])
+        ctx.index = search.Index(index_dir, ckpt["search"]["shards"], at)
+    else:
+        log.info(f"{ctx.title}: dumped without search index, --render builds it")
 
-        # writing messages
-        makehtml(filename, page, count, target, chat, const_offset_count)
+    ctx.header = mainfile % (
+        str_esc(chat["title"]),
+        str_esc(chat["info"]),
+        str_esc(chat["title"]),
+    )
+    first_page = ckpt["page"]
+    open_page(ctx, first_page, resume)
 
-        # to the next page
-        if page + 1 != page_count:
-            a = f'\n<a class="pagination block_link" href="messages{page + 2}.html">Cледующая страница ( {page + 2} / {page_count} )</a>\n'
-            util.append(filename, a)
+    # writing messages
+    makehtml(ctx, history, count)
 
-        # html eof
-        util.append(filename, "</div></div></div></body></html>")
+    ckpt["body_end"] = close_page(ctx, ckpt["page"], last=True)
 
-        # prettify
-        util.html_fmt(filename)
+    if ctx.index:
+        with stages.stage("search"):
+            ctx.index.save(ckpt["page"], ckpt["page_items"], ctx.items_done)
 
     # json eof
-    util.append("result.json", "]")
+    if out["pretty"]:
+        ckpt["sizes"]["pretty"] = out["pretty"].tell()
+        out["pretty"].write("\n]" if ctx.items_done else "]")
+
+    for sink in filter(None, out.values()):
+        sink.close()
+
+    ckpt["sizes"]["raw"] = os.path.getsize(files["raw"])
+    ckpt["sizes"]["irc"] = os.path.getsize(files["irc"])
+    ckpt.update(
+        count=ctx.items_done,
+        prev_id=ctx.prev_id,
+        prev_date=ctx.prev_date,
+        users=[*ctx.users],
+    )
+
+    # everything the pages are pointing to; the checkpoint comes only after,
+    # so an interrupted drain is done again by the next --update
+    dwq.drain(progress, group=ctx)
+    relink(ctx, range(first_page, ckpt["page"] + 1))
+    util.write(
+        ctx.path("checkpoint.json"), json.dumps(ckpt, ensure_ascii=False, indent=4)
+    )
+
+    # pages are already indented, bs4 pass only on request
+    if args.prettify:
+        pages = range(first_page, ckpt["page"] + 1)
+        util.html_fmt_pool([ctx.path("messages%s.html" % p) for p in pages])
 
-    # beatify json + irc.txt generation
-    with open("result.json", "r", encoding="utf-8") as f:
-        d = json.load(f)
+    # placeholders of an offline run are not worth caching; in full at the
+    # end of the run, see close_all()
+    if not args.render:
+        profiles.save(util.SAVE_EVERY)
+    thumbs.save(util.SAVE_EVERY)
+    ctx.store.save(util.SAVE_EVERY)
+    ctx.manifest.save(util.SAVE_EVERY)
 
-    table = []
 
-    for msg in d:
-        if any(("text" not in msg, not msg["text"])):
+def relink(ctx, pages):
+    # links to media the pool couldn't download are changed to vk links, in
+    # every page of this run since quotes repeat them
+    if not ctx.missing:
+        return
+
+    subs = {f'href="{href}"': f'href="{link}"' for href, link in ctx.missing}
+    pattern = re.compile("|".join(map(re.escape, subs)))
+    ctx.missing.clear()
+
+    last = pages[-1]
+    for page in pages:
+        path = ctx.path("messages%s.html" % page)
+        with open(path, encoding="utf-8", newline="") as f:
+            old = f.read()
+        new = pattern.sub(lambda m: subs[m[0]], old)
+        if new == old:
             continue
 
-        u = rqst_user(msg["from_id"])
-        table.append([u["name"], msg["text"]])
+        with open(path, "w", encoding="utf-8", newline="") as f:
+            f.write(new)
+        # the footer has no links, the body just got longer
+        if page == last:
+            ctx.ckpt["body_end"] += len(new.encode()) - len(old.encode())
+
+
+def read_raw(path):
+    # stored messages one by one, memory doesn't depend on the size of the dump
+    with util.open_text(path) as f:
+        if not path.endswith(".json"):
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+            return
+
+        # result.json of older dumps, one big array decoded piece by piece
+        dec = json.JSONDecoder()
+        buf, pos = "", 0
+        for chunk in iter(lambda: f.read(1 << 20), ""):
+            buf = buf[pos:] + chunk
+            pos = 0
+
+            while True:
+                while pos < len(buf) and buf[pos] in "[,] \n\r\t":
+                    pos += 1
+                try:
+                    msg, pos = dec.raw_decode(buf, pos)
+                except json.JSONDecodeError:
+                    break  # continues in the next chunk
+                yield msg
+
+        if buf[pos:].strip():
+            log.warning(f"{path}: unreadable tail of {len(buf) - pos} chars")
+
+
+def archive(root):
+    # one store and one manifest per archive, shared by the dialogs rendered
+    # at once; instances of their own would save over each other
+    with archives_lock:
+        if root not in archives:
+            archives[root] = (
+                Store(os.path.join(root, "objects")),
+                Manifest(os.path.join(root, "manifest.json")),
+            )
+        return archives[root]
 
-    util.append("irc.txt", tabulate(table, tablefmt="plain"))
 
-    with open("result.json", "w", encoding="utf-8") as f:
-        json.dump(d, f, indent=4, ensure_ascii=False)
+def rerender(root):
+    # the same dump built again from its raw messages and downloaded media
+    start_time = time.time()
+    ctx = Dump(0)
+    ctx.root = os.path.abspath(root)
+
+    old = {}
+    if os.path.isfile(ctx.path("checkpoint.json")):
+        with open(ctx.path("checkpoint.json"), encoding="utf-8") as f:
+            old = json.load(f)
+
+    name = os.path.basename(ctx.root)
+    chat = old.get("chat") or {
+        "title": name.rpartition(" (")[0] or name,
+        "photo": "",
+        "info": "",
+    }
+    ctx.title = chat["title"]
+
+    sources = [old.get("raw"), "result.ndjson", "result.ndjson.gz", "result.json"]
+    src = next((f for f in sources if f and os.path.isfile(ctx.path(f))), None)
+    if src is None:
+        log.error(f"{root}: no stored messages")
+        return
+
+    # old dumps are moved to ndjson on the way, so --update works on them
+    legacy = src == "result.json"
+    ctx.ckpt = new_ckpt("result.ndjson" + COMPRESS[args.compress] if legacy else src)
+    ctx.ckpt["chat"] = chat
+    if legacy:
+        ctx.ckpt["sizes"].pop("pretty", None)
+
+    # the number of pages may change
+    for f in os.listdir(ctx.root):
+        if f.startswith("messages") and f.endswith((".html", ".attachments.js")):
+            os.unlink(ctx.path(f))
+
+    # attachments are in the store of the archive the dialog is in
+    ctx.store, ctx.manifest = archive(os.path.dirname(ctx.root))
+
+    messages = read_raw(ctx.path(src))
+    history = iter(lambda: list(itertools.islice(messages, 200)), [])
+    writedump(ctx, history, old.get("count", 0), save_raw=legacy)
 
     end_time = util.float_fmt(time.time() - start_time, 0)
     end_time = timedelta(seconds=int(end_time))
 
-    log.success(f"{chat['title']} finished in {end_time} ")
-    os.chdir("..")
+    log.success(f"{chat['title']} rendered in {end_time} ")
+
+
+def close_all():
+    if not args.render:
+        profiles.save()
+    thumbs.close()
+    with archives_lock:
+        for store, manifest in archives.values():
+            store.save()
+            manifest.save()
+
+
+def makedump_all(targets, dump=makedump):
+    # dialogs are independent, api calls are paced by the shared client
+    try:
+        if args.jobs <= 1:
+            for t in targets:
+                dump(t)
+            return
+
+        with ThreadPoolExecutor(args.jobs, thread_name_prefix="dump") as pool:
+            for fut in [pool.submit(dump, t) for t in targets]:
+                try:
+                    fut.result()
+                except Exception as ex:
+                    log.opt(exception=True).error(f"dump failed: {ex!r}")
+    finally:
+        close_all()
 
 
 if __name__ == "__main__":
@@ -893,8 +1566,25 @@ if __name__ == "__main__":
     add("-a", "--auth",    default="",             help="login info (token or login:pass)")
     add("-n", "--pagenum", type=int, default=1000, help="number of messages in one html file")
     add("-r", "--rewrite", action="store_true",    help="force rewriting files")
-    add("-t", "--threads", type=int, default=5,    help="number of threads for m3u8 downloading")
+    add("-u", "--update",  action="store_true",    help="only add messages newer than the previous dump")
+    add("--verify",        action="store_true",    help="check downloaded files against the server size, fetch again what doesn't match")
+    add("--render",        action="store_true",    help="rebuild existing dumps (targets are their folders) offline")
+    add("-t", "--threads", type=int, default=5,    help="threads for m3u8 and video fragments")
+    add("-w", "--workers", type=int, default=8,    help="number of threads for media downloading")
+    add("--limits",        default="",             help="threads per media type: photo=6,doc=2 (photo/thumb/video/music/doc/voice/sticker/userpic)")
+    add("-e", "--execute", type=int, default=25,   help="getHistory requests in one execute call (1 to disable)")
+    add("-j", "--jobs",    type=int, default=1,    help="number of dialogs dumped at once")
+    add("--rps",           type=float, default=3,  help="api requests per second, shared by all jobs")
     add("-v", "--verbose", action="store_true",    help="verbose logging to file")
+    add("-z", "--compress", choices=["gzip"],      help="compress result.ndjson on the fly")
+    add("--pretty",        action="store_true",    help="also save indented result.json")
+    add("--prettify",      action="store_true",    help="reformat html pages with bs4 after dumping")
+    add("--fwd-depth",     type=int, default=10,   help="nesting of replies and forwards rendered in full, deeper is collapsed")
+    add("--cache-ttl",     type=int, default=7,    help="days before cached profiles are requested again")
+    add("--thumb-procs",   type=int, default=0,    help="processes for thumbnails (0 = one per cpu)")
+    add("--api",           default="",             help="api server url instead of api.vk.ru (see fakevk.py)")
+    add("--profile",       default="", metavar="FILE", help="save time, calls and bytes of every stage to a json report")
+    add("--cprofile",      action="store_true",    help="with --profile, also save cProfile stats next to the report")
 
     g = ap.add_argument_group('filter options')
     add = g.add_argument
@@ -907,6 +1597,7 @@ if __name__ == "__main__":
     add("--nosticker",  action="store_true", help="don't save stickers")
     add("--nodoc",      action="store_true", help="don't save documents")
     add("--nojson",     action="store_true", help="don't save json applications")
+    add("--nosearch",   action="store_true", help="don't build the search index")
     add("--noall",      action="store_true", help="don't save anything (except json)")
 
     ap.add_argument("targets", nargs="*", help="dialogs to dump")
@@ -923,8 +1614,6 @@ if __name__ == "__main__":
         args.nosticker = True
         args.nodoc = True
 
-    args.pagenum = args.pagenum // 200 + 1
-
     log.remove(0)
     log.add(
         sys.stderr,
@@ -935,6 +1624,19 @@ if __name__ == "__main__":
         level=5,
     )
 
+    if args.profile:
+        stages.enable(args.cprofile)
+        atexit.register(stages.report, args.profile, "im")
+
+    if args.render:
+        # no api, no downloads: only what the dumps already have
+        dwq = MediaQueue(args.workers, parse_limits(args.limits))
+        profiles = Profiles("vk_profiles.json", lambda *a: None, float("inf"))
+        thumbs = Thumbs("vk_thumbs.json", args.thumb_procs or None)
+
+        makedump_all(args.targets, rerender)
+        sys.exit()
+
     # not very helpful tbh
     def rqst_cookies(login):
         ret = "# Netscape HTTP Cookie File\n"
@@ -955,27 +1657,48 @@ if __name__ == "__main__":
         return ret
 
     def rqst_dialogs():
-        conversations = []
-        count = rqst_method("messages.getConversations", {"count": 0})["count"]
-        range_count = count // 200 + 1
+        # peer id => conversation, newest first; users and groups of the
+        # extended response go straight into the profile cache
+        dialogs = {}
+        offset, count = 0, 1
 
-        for offset in range(range_count):
-            if range_count > 1:
-                progress("loading dialogs %s/%s" % (offset, range_count))
+        while offset < count:
+            if count > 200:
+                progress("loading dialogs %s/%s" % (offset, count))
 
             chunk = rqst_method(
                 "messages.getConversations",
-                {"count": 200, "extended": 1, "offset": offset * 200},
+                {"count": 200, "extended": 1, "offset": offset, "fields": "photo_200"},
             )
+            count = chunk["count"]
+            offset += 200
+            if not chunk["items"]:
+                break
 
-            for item in chunk["items"]:
-                conv_id = item["conversation"]["peer"]["id"]
-
-                if conv_id not in conversations:
-                    conversations.append(conv_id)
+            profiles.harvest(chunk.get("profiles", []), chunk.get("groups", []))
 
-        log.info("loaded %s dialogs!" % len(conversations))
-        return conversations
+            for item in chunk["items"]:
+                conv = item["conversation"]
+                peer = conv["peer"]["id"]
+                if peer in dialogs:
+                    continue
+
+                dialogs[peer] = {
+                    "type": conv["peer"].get("type", ""),
+                    "title": conv.get("chat_settings", {}).get("title", ""),
+                    "last_message_id": conv.get("last_message_id", 0),
+                    "unread": conv.get("unread_count", 0),
+                }
+
+        # anyone the response didn't have, in one batch
+        profiles.resolve(p for p in dialogs if p < 2e9)
+        for peer, d in dialogs.items():
+            if not d["title"] and peer < 2e9:
+                d["title"] = profiles.get(peer)["name"]
+
+        unread = sum(1 for d in dialogs.values() if d["unread"])
+        log.info("loaded %s dialogs (%s unread)!" % (len(dialogs), unread))
+        return dialogs
 
     if not args.auth:
         args.auth = f"{input('Login: ')}:{input('Pass: ')}"
@@ -1004,13 +1727,49 @@ if __name__ == "__main__":
 
     elif len(args.auth) >= 85:
         vk_session = VkApi(token=args.auth)
+        # no vk_audio without a login, tracks stay m.vk.com links
         log.warning("token used, music will not dumped")
-        args.skip_music = True
+        args.nomusic = True
 
     else:
         log.error("login info is invalid!")
         sys.exit(1)
 
+    if args.api:
+        api_redirect(vk_session, args.api)
+
+    # invalid user / no access to chat / invalid group / execute response is
+    # too big; any other runtime error of execute (13) is False. a parameter
+    # error (100) other than an unknown group is a bug and stays an error
+    api = Client(
+        vk_session,
+        args.rps,
+        none=(113, 917),
+        false=(13,),
+        none_msgs=("group_ids is undefined", "size is too big"),
+    )
+
+    # long downloads don't take every worker
+    dwq = MediaQueue(args.workers, {"video": 2, **parse_limits(args.limits)})
+    profiles = Profiles("vk_profiles.json", rqst_method, args.cache_ttl * 86400)
+    thumbs = Thumbs("vk_thumbs.json", args.thumb_procs or None)
+
+    # byedpi
+    # "proxy": "socks5://localhost:1080"
+    videos = Videos(
+        {
+            "quiet": not args.verbose,
+            "verbose": False,
+            "format": "best",
+            "extractor_retries": 2,
+            "fragment_retries": 2,
+            "concurrent_fragment_downloads": args.threads,
+            "socket_timeout": 20,
+            "retries": 2,
+        },
+        vk_cookies,
+    )
+
     me = rqst_method("users.get")[0]
     me_fl = util.esc(me["first_name"] + " " + me["last_name"])
     m = "%s (%s)" % (me_fl, me["id"])
@@ -1037,31 +1796,31 @@ if __name__ == "__main__":
             shutil.copytree("blank", f"{me_dir}/blank")
         os.chdir(me_dir)
 
-        for i in range(len(conversations)):
-            users = {}
-            prev_id = items_done = prev_date = 0
-            progress_str = ""
-            makedump(conversations[i])
+        # attachments are stored once for all dialogs of the account
+        store, manifest = archive(os.path.abspath("."))
+        makedump_all(conversations)
 
         # FIXME: stopwatch
         end_time = util.float_fmt(time.time() - start_time, 0)
         end_time = timedelta(seconds=int(end_time))
 
         log.info("all saved in: %s" % end_time)
+        log.info(api.summary())
+        log.info(videos.summary())
+        videos.close()
 
         shutil.rmtree("blank")
         sys.exit()
 
-    for t in args.targets:
-        users = {}
-        prev_id = items_done = prev_date = 0
-        progress_str = ""
+    store, manifest = archive(os.path.abspath("."))
 
+    targets = []
+    for t in args.targets:
         if t == "me":
-            makedump(rqst_method("users.get")[0]["id"])
+            targets.append(rqst_method("users.get")[0]["id"])
 
         elif t.startswith("@"):
-            makedump(2000000000 + int(t[1:]))
+            targets.append(2000000000 + int(t[1:]))
 
         else:
             work = None
@@ -1081,4 +1840,9 @@ if __name__ == "__main__":
             if work is None:
                 log.error(f"{t} is invalid")
             else:
-                makedump(int(work))
+                targets.append(int(work))
+
+    makedump_all(targets)
+    log.info(api.summary())
+    log.info(videos.summary())
+    videos.close()
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+# every downloaded file of an archive, so re-runs skip them without touching
+# the disk; `python manifest.py` checks the files against it
+import argparse
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from loguru import logger as log
+
+import util
+
+
+class Manifest(util.State):
+    # path (relative to the manifest) => {id, size, mtime, etag, sha256};
+    # a file in it is not looked for on disk again, one that isn't is looked
+    # for once and added, so a dump from before the manifest fills it on the way
+    def __init__(self, path):
+        super().__init__(path)
+        self.root = self.path.parent
+        self.ids = {}  # id => path, url or vk object id
+        self.fresh = not self.loaded
+
+        for rel, e in self.items.items():
+            if e.get("id"):
+                self.ids[e["id"]] = rel
+
+    def key(self, path):
+        return Path(os.path.relpath(os.path.abspath(path), self.root)).as_posix()
+
+    def has(self, path):
+        key = self.key(path)
+        with self.lock:
+            if key in self.items:
+                return True
+        if os.path.isfile(path):
+            self.put(path)
+            return True
+        return False
+
+    def find(self, id):
+        # where the file of `id` is, wherever in the archive it was put
+        with self.lock:
+            rel = self.ids.get(id)
+        return self.root / rel if rel else None
+
+    def put(self, path, id=None, etag=None, sha256=None):
+        st = os.stat(path)
+        e = {"id": id, "size": st.st_size, "mtime": st.st_mtime_ns}
+        if etag:
+            e["etag"] = etag
+        if sha256:
+            e["sha256"] = sha256
+
+        key = self.key(path)
+        with self.lock:
+            self.items[key] = e
+            if id:
+                self.ids[id] = key
+            self.dirty = True
+
+    def drop(self, key):
+        with self.lock:
+            e = self.items.pop(key, None)
+            if e and self.ids.get(e.get("id")) == key:
+                del self.ids[e["id"]]
+            self.dirty = True
+
+
+def check(m, key, e, hashes, quick):
+    # None if the file is what the manifest says, the reason otherwise
+    path = m.root / key
+    try:
+        st = os.stat(path)
+    except OSError:
+        return "missing"
+
+    if st.st_size != e["size"]:
+        return f"size {st.st_size} != {e['size']}"
+    if quick or not e.get("sha256"):
+        return None
+
+    # hard links of one object are hashed once
+    inode = (st.st_dev, st.st_ino)
+    with m.lock:
+        h = hashes.get(inode)
+    if h is None:
+        h = util.sha256(path)
+        with m.lock:
+            hashes[inode] = h
+
+    return None if h == e["sha256"] else "sha256 mismatch"
+
+
+def verify(path, jobs=8, quick=False, fix=False):
+    m = Manifest(path)
+    if m.fresh:
+        log.error(f"{path}: no manifest")
+        return False
+
+    items = list(m.items.items())
+    hashes = {}
+    with ThreadPoolExecutor(jobs) as ex:
+        results = list(ex.map(lambda kv: check(m, *kv, hashes, quick), items))
+
+    bad = [(key, e, r) for (key, e), r in zip(items, results) if r]
+    for key, e, reason in bad:
+        log.warning(f"{key}: {reason}")
+        if not fix:
+            continue
+
+        # dropped, so the next run downloads it again; a damaged file goes
+        # with the store object it is a link to
+        m.drop(key)
+        file = m.root / key
+        if reason != "missing" and e.get("sha256"):
+            obj = m.root / "objects" / e["sha256"][:2] / (e["sha256"] + file.suffix)
+            if obj.exists() and os.path.samefile(obj, file):
+                obj.unlink()
+        if reason != "missing":
+            file.unlink()
+
+    m.save()
+    total = sum(e["size"] for e in m.items.values())
+    log.info(
+        f"{path}: {len(items)} files, {len(hashes)} hashed, {len(bad)} bad, "
+        f"{total / 2**20:.1f} MB"
+    )
+    return not bad
+
+
+if __name__ == "__main__":
+    # fmt: off
+    ap = argparse.ArgumentParser(description="check downloaded files against manifest.json")
+    add = ap.add_argument
+
+    add("-j", "--jobs",  type=int, default=os.cpu_count() or 4, help="files checked at once")
+    add("-q", "--quick", action="store_true",  help="sizes only, no hashing")
+    add("--fix",         action="store_true",  help="forget and delete bad files, the next run downloads them again")
+    add("paths",         nargs="*", default=["."], help="manifests or the folders they are in")
+
+    args = ap.parse_args()
+    # fmt: on
+
+    ok = True
+    for p in args.paths:
+        p = Path(p)
+        if p.is_dir():
+            p = p / "manifest.json"
+        ok &= verify(p, args.jobs, args.quick, args.fix)
+
+    sys.exit(0 if ok else 1)
@@ -0,0 +1,88 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from loguru import logger as log
+
+
+def parse_limits(s):
+    # "photo=6,doc=2" => {"photo": 6, "doc": 2}
+    limits = {}
+    for part in filter(None, s.split(",")):
+        kind, _, n = part.partition("=")
+        limits[kind.strip()] = int(n)
+    return limits
+
+
+class MediaQueue:
+    # bounded background downloads, one pool per media type
+    def __init__(self, threads=8, limits=None, backlog=512):
+        self.threads = threads
+        self.limits = limits or {}
+        self.active = threading.BoundedSemaphore(threads)
+        self.backlog = threading.BoundedSemaphore(backlog)
+        self.lock = threading.Lock()
+        self.pools = {}
+        self.futures = {}
+        self.queued = {}
+        self.done = 0
+
+    def pool(self, kind):
+        # with self.lock held, two threads would make two pools for one kind
+        if kind not in self.pools:
+            n = min(self.limits.get(kind, self.threads), self.threads)
+            self.pools[kind] = ThreadPoolExecutor(n, thread_name_prefix=kind)
+        return self.pools[kind]
+
+    def submit(self, kind, key, fn, *args, group=None):
+        # same file from several messages is fetched once
+        with self.lock:
+            if key in self.queued:
+                return
+            self.queued[key] = group
+
+        # blocks rendering while the queue is full
+        self.backlog.acquire()
+        with self.lock:
+            fut = self.pool(kind).submit(self._run, kind, fn, args)
+            self.futures.setdefault(group, []).append(fut)
+
+    def _run(self, kind, fn, args):
+        try:
+            with self.active:
+                fn(*args)
+        except Exception as ex:
+            log.opt(exception=True).error(f"{kind}: {ex!r}")
+        finally:
+            self.backlog.release()
+            with self.lock:
+                self.done += 1
+
+    def pending(self, group=None):
+        # `group` is whoever submitted the jobs (one dialog), None for all
+        with self.lock:
+            for g in [group] if group is not None else list(self.futures):
+                left = [f for f in self.futures.get(g, []) if not f.done()]
+                if left:
+                    self.futures[g] = left
+                else:
+                    self.futures.pop(g, None)
+
+            if group is not None:
+                return len(self.futures.get(group, []))
+            return sum(map(len, self.futures.values()))
+
+    def drain(self, progress=None, group=None):
+        while n := self.pending(group):
+            if progress:
+                progress(f"media: {n} left, {self.done} done")
+            time.sleep(0.5)
+
+        with self.lock:
+            for key in [k for k, g in self.queued.items() if group in (None, g)]:
+                del self.queued[key]
+
+    def close(self):
+        self.drain()
+        for p in self.pools.values():
+            p.shutdown()
@@ -1,16 +1,21 @@
 #!/usr/bin/env python3
 import os
+import shutil
 import sys
+import tempfile
 import requests
-import time
 import re
-import math
 import optparse
+import atexit
 import ffmpeg
 import concurrent.futures
 from glob import glob
 
+import net
+import stages
 import util
+from api import Client
+from manifest import Manifest
 
 from loguru import logger as log
 
@@ -21,138 +26,158 @@ from vk_api.exceptions import AuthError, AccessDenied
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 from cryptography.hazmat.backends import default_backend
 
-m3u8_threads = 3
-skip_existing = True
 ranges = []
 
 
 def progress(string):
-    print(" " * os.get_terminal_size().columns, end="\r")
+    print(" " * shutil.get_terminal_size().columns, end="\r")
     print(string, end="\r")
 
 
 def rqst_method(method, values={}):
-    while True:
-        try:
-            r = vk_session.method(method, values)
-            return r
-
-        except Exception as e:
-            e = str(e)
-
-            # invalid login/pass
-            if "[5] User authorization failed:" in e:
-                log.error("autechre error: " + e[31:])
-                sys.exit()
-
-            # non-existing user
-            if "Invalid user id" in e:
-                return None
-
-            # non-existing group
-            if "group_ids is undefined" in e:
-                return None
-
-            # non-existing chat
-            if "no access to this chat" in e:
-                return None
-
-            # idk
-            if "Internal server error" in e:
-                log.warning("internal catched, waiting...   ")
-                time.sleep(100)
-
-            else:
-                log.error(f"execption in '{method}': {e}, values={values}   ")
-                time.sleep(10)
-
-
-def rqst_multiple(track, final_name=""):
-    # https://github.com/Zerogoki00/vk-audio-downloader
-    def m3u8_block(block, key_url):
-        def rqst_decryptor(u):
-            k = util.get_with_retries(u, max_retries=50).content
-            c = Cipher(
-                algorithms.AES(k), modes.CBC(b"\x00" * 16), backend=default_backend()
-            )
-
-            return c.decryptor()
-
-        segments = []
-        segment_urls = re.findall(r"#EXTINF:\d+\.\d{3},\s(\S*)", block)
+    return api.method(method, values)
 
-        for s_url in segment_urls:
-            # base_url
-            u = track["url"][: track["url"].rfind("/")] + "/" + s_url
-            segments.append(util.get_with_retries(u).content)
 
-        if "METHOD=AES-128" in block:
-            segment_key_url = re.findall(r':METHOD=AES-128,URI="(\S*)"', block)[0]
+class Result:
+    # what rqst_multiple did with one track
+    def __init__(self, track, path, status, size=0, error=""):
+        self.track = track
+        self.path = path
+        self.status = status  # "done", "exists" or "failed"
+        self.size = size
+        self.error = error
 
-            decryptor = rqst_decryptor(key_url)
-            if segment_key_url != key_url:
-                decryptor = rqst_decryptor(segment_key_url)
+    @property
+    def ok(self):
+        return self.status != "failed"
 
-            for j, seg in enumerate(segments):
-                segments[j] = decryptor.update(seg)
+    def __repr__(self):
+        return f"Result({self.status!r}, {self.path!r})"
 
-        return b"".join(segments)
-
-    block_size = 1024  # 1 Kibibyte
 
+def track_name(track):
     name = "%s - %s" % (
         util.str_cut(track["artist"], 100, ""),
         util.str_cut(track["title"], 100, ""),
     )
+    return util.esc("%s (%s)" % (name, track["id"])) + ".mp3"  # ntfs escaping
+
+
+# https://github.com/Zerogoki00/vk-audio-downloader
+def m3u8_block(url, block, key_url):
+    def rqst_decryptor(u):
+        k = util.get_with_retries(u, max_retries=50).content
+        c = Cipher(
+            algorithms.AES(k), modes.CBC(b"\x00" * 16), backend=default_backend()
+        )
+
+        return c.decryptor()
+
+    segments = []
+    segment_urls = re.findall(r"#EXTINF:\d+\.\d{3},\s(\S*)", block)
+
+    for s_url in segment_urls:
+        # base_url
+        u = url[: url.rfind("/")] + "/" + s_url
+        segments.append(util.get_with_retries(u).content)
+
+    if "METHOD=AES-128" in block:
+        segment_key_url = re.findall(r':METHOD=AES-128,URI="(\S*)"', block)[0]
+
+        decryptor = rqst_decryptor(key_url)
+        if segment_key_url != key_url:
+            decryptor = rqst_decryptor(segment_key_url)
+
+        for j, seg in enumerate(segments):
+            segments[j] = decryptor.update(seg)
+
+    return b"".join(segments)
+
+
+def rqst_multiple(
+    track,
+    final_name="",
+    dest=".",
+    threads=3,
+    skip_existing=False,
+    progress=None,
+    manifest=None,
+):
+    # one track => mp3 with tags and cover; everything temporary is in a
+    # directory of its own, so any number of tracks can be processed at once
+    def show(string):
+        if progress:
+            progress(string)
 
     desc = "%s - %s" % (
         util.str_cut(track["artist"], 50, ""),
         util.str_cut(track["title"], 50, ""),
     )
 
-    if not final_name:
-        final_name = "%s (%s).mp3" % (name, track["id"])
-        final_name = util.escut(final_name, 0)  # ntfs escaping
+    final_name = final_name or os.path.join(dest, track_name(track))
+    dest = os.path.dirname(os.path.abspath(final_name))
 
+    # by track id, wherever it was saved; the folder is walked only when
+    # there is no manifest or it's new, for tracks of an older dump
+    audio_id = f"audio{track['owner_id']}_{track['id']}"
     if skip_existing:
-        glob_esc = {"[": "[[]", "]": "[]]"}
-        glob_fn = "".join(glob_esc.get(c, c) for c in final_name)
-        if glob("**/%s" % glob_fn, recursive=True):
+        found = manifest.find(audio_id) if manifest else None
+        if found is None and (not manifest or manifest.fresh):
+            glob_esc = {"[": "[[]", "]": "[]]"}
+            glob_fn = "".join(glob_esc.get(c, c) for c in os.path.basename(final_name))
+            hits = glob("**/%s" % glob_fn, root_dir=dest, recursive=True)
+            if hits:
+                found = os.path.join(dest, hits[0])
+                if manifest:
+                    manifest.put(found, audio_id)
+
+        if found:
             log.warning("exists | %s " % desc)
-            return
+            return Result(track, final_name, "exists")
+
+    try:
+        # next to the result, so it's moved in place without copying
+        with tempfile.TemporaryDirectory(prefix=".mu-", dir=dest) as tmp:
+            ts_path = os.path.join(tmp, "mu.ts")
+            error = rqst_stream(track, ts_path, threads, desc, show)
+            if error:
+                log.error(error)
+                return Result(track, final_name, "failed", error=error)
+
+            mux(track, ts_path, tmp, final_name, desc, show)
+
+    except Exception as ex:
+        log.error(f"{desc}: {ex!r}")
+        return Result(track, final_name, "failed", error=repr(ex))
+
+    if manifest:
+        manifest.put(final_name, audio_id)
+
+    size = os.path.getsize(final_name)
+    log.success("%s (%s)" % (desc, util.sizeof_fmt(size)))
+    return Result(track, final_name, "done", size)
+
 
+def rqst_stream(track, ts_path, threads, desc, show):
+    # the whole stream => ts_path, error message or None
     if ".mp3" in track["url"]:
-        with requests.get(track["url"], stream=True, timeout=10) as r:
-            if not r:
-                log.error("%s: bad r (%s)" % (desc, r.status_code))
-                return
-
-            cl = int(r.headers.get("Content-Length", "0")) or None
-            dw_total = 0
-            with open("mu.ts", "wb", buffering=block_size) as file:
-                for data in r.iter_content(chunk_size=block_size):
-                    try:
-                        file.write(data)
-                        dw_total += len(data)
-
-                        percent = (
-                            math.ceil(cl / block_size)
-                            / math.ceil(dw_total / block_size)
-                        ) * 100
-
-                        progress(
-                            f"{desc}: {int(percent)}% {util.sizeof_fmt(cl)} / {util.sizeof_fmt(dw_total)}"
-                        )
-
-                    except Exception as e:
-                        log.error("%s (%s)" % (os.path.basename(dir), str(e)))
-                        time.sleep(5)
+
+        def show_mp3(done, total):
+            if total:
+                show(
+                    f"{desc}: {int(done / total * 100)}% {util.sizeof_fmt(total)} / {util.sizeof_fmt(done)}"
+                )
+
+        with stages.stage("stream") as st:
+            try:
+                st.bytes = net.download(track["url"], ts_path, progress=show_mp3)
+            except requests.HTTPError as ex:
+                return "%s: bad r (%s)" % (desc, ex.response.status_code)
 
     elif ".m3u8" in track["url"]:
         r = util.get_with_retries(track["url"]).content
         if not r:
-            log.error("rip response | %s" % track)
-            return
+            return "rip response | %s" % track
 
         parts = r.decode("utf-8").split("#EXT-X-KEY")
 
@@ -162,53 +187,48 @@ def rqst_multiple(track, final_name=""):
                 blocks.append(b)
 
         if not blocks:
-            log.error("internal | %s" % desc)
-            return
+            return "internal | %s" % desc
 
         key_url = re.findall(r':METHOD=AES-128,URI="(\S*)"', blocks[0])[0]
 
         # https://stackoverflow.com/a/63514035
-        with concurrent.futures.ThreadPoolExecutor(
-            max_workers=m3u8_threads
-        ) as executor:
-            future_to_blk = {
-                executor.submit(m3u8_block, blk, key_url): (i, blk)
-                for i, blk in enumerate(blocks)
-            }
-            futures = {}
-
-            for future in concurrent.futures.as_completed(future_to_blk):
-                i, blk = future_to_blk[future]
-                futures[i] = blk, future
-
-                percent = (len(futures) / (len(blocks))) * 100
-
-                print(
-                    f"{desc}: {int(percent)}% {len(blocks)} / {len(futures)}", end="\r"
-                )
-
-            for i, _ in enumerate(futures):
-                blk, future = futures[i]
-                try:
-                    with open("frag%s.ts" % i, "wb") as file:
-                        file.write(future.result())
+        with (
+            stages.stage("stream") as st,
+            concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor,
+        ):
+            futures = [
+                executor.submit(m3u8_block, track["url"], blk, key_url)
+                for blk in blocks
+            ]
+
+            for done, f in enumerate(concurrent.futures.as_completed(futures), 1):
+                # a track with a hole is not a track, it fails and is fetched
+                # again next time; fragments not started yet are dropped
+                if f.exception():
+                    for other in futures:
+                        other.cancel()
+                    ex = f.exception()
+                    return (
+                        f"{desc}: fragment {futures.index(f)} / {len(blocks)}, {ex!r}"
+                    )
+
+                percent = (done / len(blocks)) * 100
+                show(f"{desc}: {int(percent)}% {len(blocks)} / {done}")
+
+            # merging fragments in one file, in order
+            with open(ts_path, "wb") as ts:
+                for future in futures:
+                    data = future.result()
+                    ts.write(data)
+                    st.bytes += len(data)
 
-                except Exception as e:
-                    log.error("%r ex: %s" % (blk, e))
+    else:
+        return "nani | %s" % track
 
-        # merging *.ts files in one
-        with open("mu.ts", "wb") as ts:
-            for i, _ in enumerate(blocks):
-                fn = "frag%s.ts" % i
-                with open(fn, "rb") as frg:
-                    ts.write(frg.read())
+    return None
 
-                util.delete_file(fn)
-                print(f"{desc}: dd {i} / {len(blocks)}          ", end="\r")
-    else:
-        log.error("nani | %s" % track)
-        return
 
+def mux(track, ts_path, tmp, final_name, desc, show):
     md = [
         f"TPE1={track['artist']}",
         f"TIT2={track['title']}",
@@ -216,33 +236,30 @@ def rqst_multiple(track, final_name=""):
     ]
     md = {f"metadata:g:{i}": e for i, e in enumerate(md)}
 
-    inputs = [ffmpeg.input("mu.ts")]
+    inputs = [ffmpeg.input(ts_path)]
 
     # add cover art
-    if track["track_covers"]:
-        with requests.get(track["track_covers"][0], stream=True) as request:
-            if request:
-                with open("cover.jpg", "wb") as file:
-                    file.write(request.content)
-
-                md["disposition:v"] = "attached_pic"
-                md["id3v2_version"] = 3
+    if track.get("track_covers"):
+        cover = os.path.join(tmp, "cover.jpg")
+        try:
+            net.download(track["track_covers"][0], cover)
+        except Exception as ex:
+            log.warning(f"{desc}: no cover, {ex!r}")
+        else:
+            md["disposition:v"] = "attached_pic"
+            md["id3v2_version"] = 3
 
-                inputs.append(ffmpeg.input("cover.jpg"))
+            inputs.append(ffmpeg.input(cover))
 
-    p = ffmpeg.output(*inputs, "mu.mp3", acodec="copy", **md).overwrite_output()
+    mp3 = os.path.join(tmp, "mu.mp3")
+    p = ffmpeg.output(*inputs, mp3, acodec="copy", **md).overwrite_output()
     # print(*ffmpeg.get_args(p))
 
-    print(f"{desc}: merging...          ", end="\r")
-    p.run(quiet=True)
-
-    util.delete_file(final_name)
-    os.rename("mu.mp3", final_name)
-    util.delete_file("mu.ts")
-    util.delete_file("cover.jpg")
+    show(f"{desc}: merging...")
+    with stages.stage("ffmpeg"):
+        p.run(quiet=True)
 
-    size = util.sizeof_fmt(os.path.getsize(final_name))
-    log.success("%s (%s)" % (desc, size))
+    os.replace(mp3, final_name)
 
 
 if __name__ == "__main__":
@@ -264,7 +281,33 @@ if __name__ == "__main__":
 
         return {"id": i, "name": n}
 
-    def rqst_album(album):
+    def rqst_tracks(tracks, dest):
+        # a few tracks at once, each one in a temp dir of its own
+        opts = {
+            "dest": dest,
+            "threads": options.m3u8_threads,
+            "skip_existing": options.skip_existing,
+            "progress": progress if options.jobs == 1 else None,
+            "manifest": manifest,
+        }
+        with concurrent.futures.ThreadPoolExecutor(options.jobs) as pool:
+            results = list(pool.map(lambda t: rqst_multiple(t, **opts), tracks))
+        manifest.save(util.SAVE_EVERY)
+
+        failed = sum(not r.ok for r in results)
+        if failed:
+            log.warning(f"{failed} / {len(results)} failed | {dest}")
+        return results
+
+    def in_ranges(tracks):
+        for i, track in enumerate(tracks, start=1):
+            if ranges and i not in ranges:
+                if i > max(ranges):
+                    break
+                continue
+            yield track
+
+    def rqst_album(album, root="."):
         if "access_hash" not in album:
             album["access_hash"] = ""
 
@@ -283,20 +326,17 @@ if __name__ == "__main__":
                 album["title"] = ""
 
         path = "%s - (%s)" % (util.str_cut(album["title"], 200), album["id"])
-        path = util.esc(path, 0)
+        path = os.path.join(root, util.esc(path))
         os.makedirs(path, exist_ok=True)
-        os.chdir(path)
 
         try:
-            for track in vk_audio.get_iter(
+            tracks = vk_audio.get_iter(
                 album["owner_id"], album["id"], album["access_hash"]
-            ):
-                rqst_multiple(track)
+            )
+            rqst_tracks(tracks, path)
         except AccessDenied:
             log.error(f"no access | {path}")
 
-        os.chdir("..")
-
     log.remove(0)
     log.add(
         sys.stderr,
@@ -324,6 +364,9 @@ if __name__ == "__main__":
         default="3",
         help="m3u8 threads",
     )
+    parser.add_option(
+        "-j", "--jobs", dest="jobs", type=int, default=1, help="tracks at once"
+    )
     parser.add_option(
         "-m", "--music", dest="music", action="store_true", help="dump music"
     )
@@ -349,10 +392,28 @@ if __name__ == "__main__":
     parser.add_option(
         "-c", "--count", dest="count", default=20, help="items count for query"
     )
+    parser.add_option(
+        "--rps", dest="rps", type=float, default=3, help="api requests per second"
+    )
+    parser.add_option(
+        "--profile", dest="profile", default="", help="json report of time per stage"
+    )
+    parser.add_option(
+        "--cprofile",
+        dest="cprofile",
+        action="store_true",
+        default=False,
+        help="with --profile, also save cProfile stats",
+    )
     options, arguments = parser.parse_args()
 
-    m3u8_threads = options.m3u8_threads
-    skip_existing = options.skip_existing
+    if options.profile:
+        stages.enable(options.cprofile)
+        atexit.register(stages.report, options.profile, "mu")
+
+    # tracks saved under the current folder, looked up by id for --exists
+    manifest = Manifest("manifest.json")
+    atexit.register(manifest.save)
 
     if options.range:
         spl = util.expand_ranges(options.range).split(",")
@@ -371,6 +432,10 @@ if __name__ == "__main__":
         log.error("autechre error: %s" % str(e))
         sys.exit(1)
 
+    # invalid user / no access to chat / invalid group, not any bad parameter
+    none_msgs = ("group_ids is undefined",)
+    api = Client(vk_session, options.rps, none=(113, 917), none_msgs=none_msgs)
+
     if options.query:
         r = ""
         tracks = []
@@ -400,15 +465,9 @@ if __name__ == "__main__":
 
         path = util.esc(options.query)
         os.makedirs(path, exist_ok=True)
-        os.chdir(path)
 
-        for i, track in enumerate(all_tracks, start=0):
-            if track == "no" or i not in rng:
-                continue
-            print(track)
-            rqst_multiple(track)
-
-        os.chdir("..")
+        chosen = [t for i, t in enumerate(all_tracks) if t != "no" and i in rng]
+        rqst_tracks(chosen, path)
 
         sys.exit()
 
@@ -438,8 +497,8 @@ if __name__ == "__main__":
                 arg = arg.removeprefix(p)
             arg = arg.removesuffix("]]")
 
-            track = vk_audio.get_audio_by_id(arg.split("_"))
-            rqst_multiple(track)
+            track = vk_audio.get_audio_by_id(*arg.split("_"))
+            rqst_multiple(track, progress=progress, manifest=manifest)
 
             continue
 
@@ -454,7 +513,6 @@ if __name__ == "__main__":
         path = util.escut(path)
 
         os.makedirs(path, exist_ok=True)
-        os.chdir(path)
 
         if not options.album and not options.music:
             log.warning("no '-m' or '-a' option, dumping all")
@@ -471,20 +529,12 @@ if __name__ == "__main__":
                     continue
 
                 log.info(f"{i} / {len(albums_list)} | {album['title']}")
-                rqst_album(album)
+                rqst_album(album, path)
                 print("")
 
         if options.music and not (options.album and ranges):
             log.info("downloading tracks...")
+            tracks = vk_audio.get_iter(owner_id=target["id"])
+            rqst_tracks(in_ranges(tracks), path)
 
-            for i, track in enumerate(
-                vk_audio.get_iter(owner_id=target["id"]), start=1
-            ):
-                if ranges and i not in ranges:
-                    if i > max(ranges):
-                        break
-                    continue
-
-                rqst_multiple(track)
-
-        os.chdir("..")
+    log.info(api.summary())
@@ -0,0 +1,265 @@
+import contextlib
+import os
+import random
+import re
+import socket
+import threading
+import time
+from collections import OrderedDict
+
+import requests
+from loguru import logger as log
+from requests.adapters import HTTPAdapter
+from urllib3 import connection, connectionpool
+from urllib3.exceptions import (
+    ConnectTimeoutError,
+    NameResolutionError,
+    NewConnectionError,
+)
+from urllib3.util.retry import Retry
+
+import stages
+
+POOL_HOSTS = 32  # hosts with connections kept open
+POOL_PER_HOST = 16  # connections per host, more threads wait for a free one
+DNS_TTL = 300
+DNS_HOSTS = 256  # hosts kept resolved, the least recently used goes first
+TIMEOUT = (10, 30)  # connect, read
+CHUNK = 65536
+
+# refused connections and 429 / 5xx are retried inside urllib3, on a kept
+# connection when there is one; a body broken halfway is retried here
+RETRY = Retry(
+    total=5,
+    backoff_factor=0.5,
+    status_forcelist=(429, 500, 502, 503, 504),
+    allowed_methods=("GET", "HEAD"),
+    respect_retry_after_header=True,
+    raise_on_status=False,
+)
+
+_lock = threading.Lock()
+_session = None
+
+_dns = OrderedDict()  # (host, port) => (time, addresses), oldest first
+_dns_lock = threading.Lock()
+
+
+def resolve(host, port):
+    # the same few cdn hosts over and over, each new connection asked the
+    # resolver; only connections of the session below look here
+    key = (host, port)
+    now = time.monotonic()
+    with _dns_lock:
+        e = _dns.get(key)
+        if e and now - e[0] < DNS_TTL:
+            _dns.move_to_end(key)
+            return e[1]
+
+    infos = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    addrs = list(dict.fromkeys(info[4][0] for info in infos))
+    with _dns_lock:
+        _dns[key] = (now, addrs)
+        _dns.move_to_end(key)
+        while len(_dns) > DNS_HOSTS:
+            _dns.popitem(last=False)
+    return addrs
+
+
+class Resolved:
+    # connects to a cached address of the host; tls still checks the name,
+    # urllib3 uses _dns_host only to open the socket
+    def _new_conn(self):
+        host = self._dns_host
+        try:
+            addrs = resolve(host, self.port)
+        except socket.gaierror as ex:
+            raise NameResolutionError(host, self, ex) from ex
+
+        for i, addr in enumerate(addrs):
+            self._dns_host = addr
+            try:
+                return super()._new_conn()
+            except (ConnectTimeoutError, NewConnectionError):
+                if i + 1 == len(addrs):
+                    raise
+            finally:
+                self._dns_host = host
+
+
+class HTTPConnection(Resolved, connection.HTTPConnection):
+    pass
+
+
+class HTTPSConnection(Resolved, connection.HTTPSConnection):
+    pass
+
+
+class HTTPPool(connectionpool.HTTPConnectionPool):
+    ConnectionCls = HTTPConnection
+
+
+class HTTPSPool(connectionpool.HTTPSConnectionPool):
+    ConnectionCls = HTTPSConnection
+
+
+class Adapter(HTTPAdapter):
+    # pools of the shared session, with connections that use resolve()
+    def init_poolmanager(self, *args, **kw):
+        super().init_poolmanager(*args, **kw)
+        self.poolmanager.pool_classes_by_scheme = {"http": HTTPPool, "https": HTTPSPool}
+
+
+def session():
+    # one for every thread of the process; urllib3 pools are thread-safe
+    global _session
+    with _lock:
+        if _session is None:
+            s = requests.Session()
+            a = Adapter(
+                pool_connections=POOL_HOSTS,
+                pool_maxsize=POOL_PER_HOST,
+                pool_block=True,
+                max_retries=RETRY,
+            )
+            s.mount("http://", a)
+            s.mount("https://", a)
+
+            stages.source("http", stats)
+            _session = s
+        return _session
+
+
+def stats():
+    # a connection made is a handshake paid, requests over it are not
+    pm = session().get_adapter("https://").poolmanager
+    pools = [pm.pools.get(k) for k in pm.pools.keys()]
+    pools = [p for p in pools if p]
+    return {
+        "hosts": len(pools),
+        "requests": sum(p.num_requests for p in pools),
+        "connections": sum(p.num_connections for p in pools),
+    }
+
+
+def backoff(first, cap, attempt):
+    # doubled on every attempt with full jitter, so parallel jobs don't come
+    # back at the same moment; api.Client waits the same way
+    d = min(cap, first * 2**attempt)
+    return random.uniform(d / 2, d)
+
+
+def get(url, tries=5, cap=30, **kw):
+    # the whole body in memory: segments, keys, covers; http errors are final
+    for attempt in range(tries):
+        try:
+            with stages.stage("download") as st:
+                r = session().get(url, timeout=TIMEOUT, **kw)
+                r.raise_for_status()
+                st.bytes = len(r.content)
+            return r
+        except requests.HTTPError:
+            raise
+        except requests.RequestException as ex:
+            if attempt + 1 == tries:
+                raise
+            d = backoff(0.5, cap, attempt)
+            log.warning(f"{url}: {ex!r}, retry in {d:.1f}s")
+            time.sleep(d)
+
+
+class Incomplete(requests.RequestException):
+    # not the number of bytes the server said, retried like a broken connection
+    pass
+
+
+def expected(r, start):
+    # full size of the file from a 200 / 206 response, None if it can't be told
+    if r.status_code == 206:
+        m = re.fullmatch(r"bytes (\d+)-\d+/(\d+)", r.headers.get("Content-Range", ""))
+        if not m or int(m[1]) != start:
+            raise Incomplete(f"bad range: {r.headers.get('Content-Range')}")
+        return int(m[2])
+
+    # a compressed body is longer once decoded
+    if r.headers.get("Content-Encoding", "identity") != "identity":
+        return None
+
+    length = r.headers.get("Content-Length")
+    return int(length) if length else None
+
+
+def download(url, path, tries=5, progress=None, headers=None, **kw):
+    # into path.part, renamed to `path` only once it has as many bytes as the
+    # server said; a break, here or in an earlier run, goes on with Range.
+    # offsets of Range are in the body as sent, so it is asked for as is
+    part = f"{os.fspath(path)}.part"
+    headers = {"Accept-Encoding": "identity", **(headers or {})}
+    resumable = True
+
+    for attempt in range(tries):
+        # compressed anyway, what's in the part can't be matched to a range
+        if not resumable and os.path.exists(part):
+            os.unlink(part)
+        have = os.path.getsize(part) if os.path.exists(part) else 0
+        h = {**headers, "Range": f"bytes={have}-"} if have else headers
+
+        try:
+            with (
+                stages.stage("download") as st,
+                session().get(url, stream=True, timeout=TIMEOUT, headers=h, **kw) as r,
+            ):
+                # the part is as big as the file or bigger, no way to tell
+                if r.status_code == 416:
+                    os.unlink(part)
+                    raise Incomplete("range not satisfiable")
+
+                r.raise_for_status()
+                if r.headers.get("Content-Encoding", "identity") != "identity":
+                    resumable = False
+                    if r.status_code == 206:
+                        raise Incomplete("compressed range")
+                if r.status_code != 206:
+                    have = 0
+                total = expected(r, have)
+
+                with open(part, "ab" if have else "wb") as f:
+                    for chunk in r.iter_content(chunk_size=CHUNK):
+                        f.write(chunk)
+                        st.bytes += len(chunk)
+                        if progress:
+                            progress(have + st.bytes, total)
+
+            size = have + st.bytes
+            if total is not None and size != total:
+                if size > total:
+                    os.unlink(part)
+                raise Incomplete(f"{size} of {total} bytes")
+
+            os.replace(part, path)
+            return size
+
+        except requests.HTTPError:
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(part)
+            raise
+        except requests.RequestException as ex:
+            if attempt + 1 == tries:
+                raise
+            d = backoff(0.5, 30, attempt)
+            log.warning(f"{url}: {ex!r}, retry in {d:.1f}s")
+            time.sleep(d)
+
+
+def remote_size(url, **kw):
+    # Content-Length of a HEAD request, None if the server doesn't say
+    try:
+        r = session().head(url, timeout=TIMEOUT, allow_redirects=True, **kw)
+        r.raise_for_status()
+    except requests.RequestException:
+        return None
+
+    length = r.headers.get("Content-Length")
+    if not length or r.headers.get("Content-Encoding", "identity") != "identity":
+        return None
+    return int(length)
@@ -4,9 +4,12 @@ import sys
 import json
 import datetime
 import argparse
-import re
+import atexit
 import asyncio
+import stages
 import util
+from api import Client
+from manifest import Manifest
 from loguru import logger as log
 from tqdm import tqdm
 from vk_api import VkApi
@@ -18,35 +21,8 @@ login_info = ""  # access token or "login:pass"
 
 
 def rqst_method(method, values={}):
-    while True:
-        try:
-            return vk.method(method, values)
-        except Exception as ex:
-            ex_str = str(ex)
-
-            # invalid login/pass
-            if "[5]" in ex_str:
-                log.error("autechre error: " + ex_str[31:])
-                sys.exit()
-
-            # invalid id / no albums in group
-            elif re.findall(r"\[100\]|\[113\]|group photos are disabled", ex_str):
-                # log.trace(f"no id / no albums: {values}, {str(ex)}")
-                return None
-
-            # no access to albums
-            elif re.findall(r"\[18\]|\[30\]|\[15\]|\[200\]", ex_str):
-                # log.error(f"no access: {values}, {str(ex)}")
-                return False
-
-            # idk
-            elif "server" in ex_str:
-                log.error("internal catched, waiting...   ")
-                time.sleep(60)
-
-            else:
-                log.error(f"{method!r}: {ex_str}")
-                time.sleep(5)
+    # None for invalid id / no albums, False for no access
+    return api.method(method, values)
 
 
 def rqst_size(data: dict) -> str:
@@ -191,7 +167,10 @@ def get_album(t_info, t_path, input_str):
     if args.simulate:
         return
 
-    asyncio.run(util.dw_album(img_dict, cwd, concurrency=args.threads))
+    asyncio.run(
+        util.dw_album(img_dict, cwd, concurrency=args.threads, manifest=manifest)
+    )
+    manifest.save(util.SAVE_EVERY)
 
     log.success(f"{count} files in {datetime.timedelta(seconds=int(sw.duration))}")
 
@@ -310,8 +289,11 @@ if __name__ == "__main__":
     add("-t", "--threads",  type=int, default=5,  help="Number of threads")
     add("-s", "--simulate", action="store_true",  help="Simulate (not download, only json with urls)")
     add("-d", "--delay",    type=int, default=15, help="Delay between chunks requests (in seconds)")
+    add("--rps",            type=float, default=3, help="Api requests per second")
     add("-j", "--json",     action="store_true",  help="album.json parsing")
     add("-v", "--verbose",  action="store_true",  help="Verbose output")
+    add("--profile",        default="",           help="Save time per stage to a json report")
+    add("--cprofile",       action="store_true",  help="With --profile, also save cProfile stats")
 
     add("targets",          nargs="*",            help="users / groups to dump")
 
@@ -332,6 +314,14 @@ if __name__ == "__main__":
         log.remove()
         log.add(lambda msg: tqdm.write(msg, end=""), colorize=True, level="TRACE")
 
+    if args.profile:
+        stages.enable(args.cprofile)
+        atexit.register(stages.report, args.profile, "ph")
+
+    # photos already saved under the current folder, instead of a stat per file
+    manifest = Manifest("manifest.json")
+    atexit.register(manifest.save)
+
     if args.json:
         current_dir = Path.cwd()
 
@@ -354,7 +344,12 @@ if __name__ == "__main__":
             sw = Stopwatch(2)
             sw.restart()
 
-            asyncio.run(util.dw_album(img_dict, cwd, concurrency=args.threads))
+            asyncio.run(
+                util.dw_album(
+                    img_dict, cwd, concurrency=args.threads, manifest=manifest
+                )
+            )
+            manifest.save(util.SAVE_EVERY)
 
             log.success(
                 f"{len(img_dict)} files in {datetime.timedelta(seconds=int(sw.duration))}"
@@ -368,6 +363,8 @@ if __name__ == "__main__":
         for file in Path(".").rglob("*.json"):
             if any(part.startswith(".") for part in file.parts):  # .venv
                 continue
+            if file.name == "manifest.json":
+                continue
 
             rqst_json(file)
 
@@ -382,14 +379,20 @@ if __name__ == "__main__":
     elif ":" in args.auth:
         lp = args.auth.split(":")
         vk = VkApi(lp[0], lp[1], app_id=2685278)
-        while True:
-            try:
-                vk.auth()
-                rqst_method("users.get")[0]["id"]  # auth test
-                break
-            except AuthError as ex:
-                log.error("autechre error: " + str(ex))
-                sys.exit()
+        try:
+            vk.auth()
+        except AuthError as ex:
+            log.error("autechre error: " + str(ex))
+            sys.exit()
+
+    api = Client(
+        vk,
+        args.rps,
+        none=(100, 113),
+        false=(15, 18, 30, 200),
+        none_msgs=("group photos are disabled",),
+    )
+    rqst_method("users.get")[0]["id"]  # auth test
 
     # from vk_api.utils import enable_debug_mode
     # enable_debug_mode(vk, print_content=True)
@@ -399,3 +402,5 @@ if __name__ == "__main__":
 
     for t in args.targets:
         parse_link(t)
+
+    log.info(api.summary())
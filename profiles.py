@@ -0,0 +1,92 @@
+import time
+
+from loguru import logger as log
+
+import util
+
+# api limits for one call
+USERS_MAX = 1000
+GROUPS_MAX = 500
+
+
+class Profiles(util.State):
+    # id => {"id", "name", "photo", "fetched_at"}, shared between dialogs and runs
+    def __init__(self, path, rqst_method, ttl=7 * 86400):
+        # dialogs dumped in parallel share one cache
+        super().__init__(path)
+        self.rqst_method = rqst_method
+        self.ttl = ttl
+        self.items = {int(k): v for k, v in self.items.items()}
+
+    def __len__(self):
+        return len(self.items)
+
+    def fresh(self, pid):
+        p = self.items.get(pid)
+        return p is not None and time.time() - p["fetched_at"] < self.ttl
+
+    def put(self, pid, name, photo):
+        self.items[pid] = {
+            "id": pid,
+            "name": name,
+            "photo": photo,
+            "fetched_at": int(time.time()),
+        }
+        self.dirty = True
+
+    def put_user(self, u):
+        self.put(
+            u["id"], u["first_name"] + " " + u["last_name"], u.get("photo_200", "")
+        )
+
+    def put_group(self, g):
+        self.put(-g["id"], g["name"], g.get("photo_200", ""))
+
+    def harvest(self, users=(), groups=()):
+        # profiles that came with another response (extended=1), no requests
+        with self.lock:
+            for u in users:
+                self.put_user(u)
+            for g in groups:
+                self.put_group(g)
+
+    def get(self, pid):
+        # the lock is never held over a request, a miss in one dialog doesn't
+        # stop the other dialogs from reading the cache
+        with self.lock:
+            fresh = self.fresh(pid)
+        if not fresh:
+            self.resolve([pid])
+
+        with self.lock:
+            if pid not in self.items:
+                # deleted / banned / invalid, remembered until ttl expires
+                name = f"id{pid}" if pid > 0 else f"club{-pid}"
+                self.put(pid, name, "")
+
+            return self.items[pid]
+
+    def resolve(self, ids):
+        # batch fetching of everything missing or stale
+        with self.lock:
+            ids = {i for i in ids if i and not self.fresh(i)}
+        u_ids = sorted(i for i in ids if i > 0)
+        g_ids = sorted(-i for i in ids if i < 0)
+
+        for n in range(0, len(u_ids), USERS_MAX):
+            chunk = ",".join(map(str, u_ids[n : n + USERS_MAX]))
+            r = self.rqst_method(
+                "users.get", {"user_ids": chunk, "fields": "photo_200"}
+            )
+            self.harvest(users=r or [])
+
+        for n in range(0, len(g_ids), GROUPS_MAX):
+            chunk = ",".join(map(str, g_ids[n : n + GROUPS_MAX]))
+            r = self.rqst_method(
+                "groups.getById", {"group_ids": chunk, "fields": "photo_200"}
+            )
+            self.harvest(groups=r or [])
+
+    def save(self, every=0):
+        if super().save(every):
+            log.trace(f"{self.path.name}: {len(self.items)} profiles saved")
@@ -0,0 +1,178 @@
+import functools
+import json
+import os
+import re
+import shutil
+from array import array
+from pathlib import Path
+
+from loguru import logger as log
+
+_word = re.compile(r"\w+")
+SNIPPET = 160
+
+
+def tokens(text):
+    # script.js splits the query the same way
+    words = _word.findall(text.lower().replace("ё", "е"))
+    return {w for w in words if 2 <= len(w) <= 32}
+
+
+@functools.lru_cache(maxsize=65536)
+def shard(token, n):
+    # fnv-1a over utf-16 code units, as SearchShardOf in script.js
+    h = 2166136261
+    data = token.encode("utf-16-le")
+    for i in range(0, len(data), 2):
+        h = ((h ^ (data[i] | data[i + 1] << 8)) * 16777619) & 0xFFFFFFFF
+    return h % n
+
+
+def shards_for(count):
+    # ~5k messages per shard, one query word loads one shard
+    return max(16, min(1024, 1 << (count // 5000).bit_length()))
+
+
+def texts(msg):
+    # everything in a message worth finding: text, forwards, attachment titles
+    yield msg.get("text", "")
+
+    for a in msg.get("attachments", []):
+        obj = a.get(a.get("type"), {})
+        if isinstance(obj, dict):
+            yield obj.get("title", "")
+            yield obj.get("artist", "")
+
+    if "reply_message" in msg:
+        yield from texts(msg["reply_message"])
+    for fwd in msg.get("fwd_messages", []):
+        yield from texts(fwd)
+
+
+def _read_js(path):
+    # SearchShard(3, {...}); => {...}
+    with open(path, encoding="utf-8") as f:
+        s = f.read()
+    return json.loads(s[s.index(",") + 1 : s.rindex(")")])
+
+
+def _write_js(path, func, key, data):
+    tmp = path.with_suffix(".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(f"{func}({key}, ")
+        json.dump(data, f, ensure_ascii=False, separators=(",", ":"))
+        f.write(");\n")
+    os.replace(tmp, path)
+
+
+class Index:
+    # search/sN.js: token => [[page, pos, pos, ...], ...] in `n` shards,
+    # search/pN.js: [anchor, date, name, snippet] of every message of page N
+    def __init__(self, root, n, resume=None):
+        self.root = Path(root)
+        self.n = n
+        self.shards = [None] * n  # token => array of page << 32 | pos
+        self.dirty = set()
+        self.page, self.docs = 0, []
+
+        # (page, items) of the checkpoint, anything after it is dropped
+        self.resume = resume
+        self.clean = True
+        if resume is None:
+            shutil.rmtree(self.root, ignore_errors=True)
+        else:
+            # an interrupted run may have saved postings past the checkpoint
+            try:
+                at = _read_js(self.root / "meta.js").get("at")
+            except Exception:
+                at = None
+            self.clean = at == list(resume)
+        self.root.mkdir(exist_ok=True)
+
+    def load(self, i):
+        postings = {}
+        path = self.root / f"s{i}.js"
+        if self.resume and path.is_file():
+            try:
+                data = _read_js(path)
+            except Exception as ex:
+                log.warning(f"{path.name} is broken, dropped: {ex!r}")
+                data = {}
+
+            rp, ritems = self.resume
+            for token, pages in data.items():
+                a = array("Q")
+                for page, *positions in pages:
+                    if page > rp:
+                        continue
+                    a.extend(
+                        page << 32 | p for p in positions if page < rp or p < ritems
+                    )
+                if a:
+                    postings[token] = a
+
+        self.shards[i] = postings
+        return postings
+
+    def open_page(self, page):
+        self.flush()
+        self.page, self.docs = page, []
+
+        path = self.root / f"p{page}.js"
+        if self.resume and page == self.resume[0] and path.is_file():
+            self.docs = _read_js(path)[: self.resume[1]]
+
+    def flush(self):
+        if self.page:
+            _write_js(
+                self.root / f"p{self.page}.js", "SearchDocs", self.page, self.docs
+            )
+
+    def add(self, page, pos, anchor, msg, name):
+        if page != self.page:
+            self.open_page(page)
+
+        parts = [t for t in texts(msg) if t]
+        snippet = next(iter(parts), "")
+        if len(snippet) > SNIPPET:
+            snippet = snippet[: SNIPPET - 1] + "…"
+        self.docs.append([anchor, msg["date"], name, snippet])
+
+        posting = page << 32 | pos
+        for token in tokens(" ".join(parts)):
+            i = shard(token, self.n)
+            postings = self.shards[i]
+            if postings is None:
+                postings = self.load(i)
+            postings.setdefault(token, array("Q")).append(posting)
+            self.dirty.add(i)
+
+    def save(self, page, items, count):
+        meta = {"shards": self.n, "pages": page, "count": count, "at": None}
+        _write_js(self.root / "meta.js", "SearchMeta", 0, meta)
+        self.flush()
+
+        if not self.clean:
+            for i in range(self.n):
+                if self.shards[i] is None:
+                    self.load(i)
+                    self.dirty.add(i)
+            for f in self.root.glob("p*.js"):
+                if int(f.stem[1:]) > page:
+                    f.unlink()
+            self.clean = True
+
+        for i in sorted(self.dirty):
+            data = {}
+            for token, a in self.shards[i].items():
+                groups = data[token] = []
+                for posting in a:
+                    p, pos = posting >> 32, posting & 0xFFFFFFFF
+                    if not groups or groups[-1][0] != p:
+                        groups.append([p])
+                    groups[-1].append(pos)
+            _write_js(self.root / f"s{i}.js", "SearchShard", i, data)
+        self.dirty.clear()
+
+        meta["at"] = [page, items]
+        _write_js(self.root / "meta.js", "SearchMeta", 0, meta)
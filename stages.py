@@ -0,0 +1,147 @@
+import cProfile
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+from datetime import datetime
+
+from loguru import logger as log
+
+try:
+    import resource
+except ImportError:  # windows
+    resource = None
+
+
+class Stage:
+    # one timed piece of work; `bytes` and `count` can be set inside the block
+    __slots__ = ("owner", "name", "start", "bytes", "count")
+
+    def __init__(self, owner, name):
+        self.owner = owner
+        self.name = name
+        self.bytes = 0
+        self.count = 1
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        if self.owner.enabled:
+            elapsed = time.perf_counter() - self.start
+            self.owner.add(self.name, elapsed, self.bytes, self.count, exc[0])
+
+
+class Stages:
+    # wall time, calls and bytes per stage of a run, from every thread; the
+    # same stage may run in many threads at once, so stages add up past the wall
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.items = {}  # name => [calls, seconds, bytes, errors]
+        self.sources = {}  # name => callable, its dict goes to the report
+        self.prof = None
+        self.start = time.perf_counter()
+        self.cpu = time.process_time()
+
+    def enable(self, cprofile=False):
+        self.enabled = True
+        self.start = time.perf_counter()
+        self.cpu = time.process_time()
+
+        # since 3.12 cProfile sees every thread, before that only this one
+        if cprofile:
+            self.prof = cProfile.Profile()
+            self.prof.enable()
+
+    def stage(self, name):
+        return Stage(self, name)
+
+    def source(self, name, fn):
+        self.sources[name] = fn
+
+    def add(self, name, seconds, nbytes=0, count=1, error=None):
+        with self.lock:
+            e = self.items.setdefault(name, [0, 0.0, 0, 0])
+            e[0] += count
+            e[1] += seconds
+            e[2] += nbytes
+            e[3] += error is not None
+
+    def stats(self):
+        with self.lock:
+            items = sorted(self.items.items(), key=lambda kv: -kv[1][1])
+            return {
+                name: {
+                    "calls": calls,
+                    "seconds": round(seconds, 4),
+                    "bytes": nbytes,
+                    "errors": errors,
+                    "mb_s": round(nbytes / 2**20 / seconds, 2) if seconds else 0,
+                }
+                for name, (calls, seconds, nbytes, errors) in items
+            }
+
+    def top(self, n=40):
+        # hottest functions by cumulative time
+        st = pstats.Stats(self.prof)
+        r = []
+        for (file, line, func), (cc, nc, tt, ct, _) in st.stats.items():
+            name = f"{os.path.basename(file)}:{line}({func})"
+            r.append({"func": name, "calls": nc, "tottime": tt, "cumtime": ct})
+
+        r.sort(key=lambda e: -e["cumtime"])
+        for e in r[:n]:
+            e["tottime"], e["cumtime"] = round(e["tottime"], 4), round(e["cumtime"], 4)
+        return r[:n]
+
+    def report(self, path, tool, **extra):
+        # json to diff between versions, pstats dump next to it with --cprofile
+        if not self.enabled:
+            return
+
+        r = {
+            "tool": tool,
+            "date": datetime.now().isoformat(timespec="seconds"),
+            "python": sys.version.split()[0],
+            "wall": round(time.perf_counter() - self.start, 3),
+            "cpu": round(time.process_time() - self.cpu, 3),
+        }
+        if resource:
+            rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            r["peak_rss_mb"] = round(
+                rss / (2**20 if sys.platform == "darwin" else 1024)
+            )
+
+        r["stages"] = self.stats()
+        for name, fn in self.sources.items():
+            r[name] = fn()
+        r.update(extra)
+
+        if self.prof:
+            self.prof.disable()
+            self.prof.dump_stats(os.path.splitext(path)[0] + ".prof")
+            r["top"] = self.top()
+
+        tmp = f"{path}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(r, f, ensure_ascii=False, indent=2)
+        os.replace(tmp, path)
+
+        log.info(f"profile: {path}")
+        for name, s in r["stages"].items():
+            log.info(
+                f"  {name:<10} {s['calls']:>7} calls {s['seconds']:>10.2f}s"
+                f" {s['bytes'] / 2**20:>10.1f} MB"
+            )
+
+
+# one per process, every tool and module shares it
+current = Stages()
+stage = current.stage
+source = current.source
+enable = current.enable
+report = current.report
@@ -0,0 +1,100 @@
+import contextlib
+import hashlib
+import os
+import shutil
+import threading
+from pathlib import Path
+
+import util
+
+
+def link(src, dst):
+    # hardlink, relative symlink on another filesystem, copy as a last resort
+    src, dst = os.fspath(src), os.fspath(dst)
+    if os.path.lexists(dst):
+        os.unlink(dst)
+
+    try:
+        os.link(src, dst)
+    except OSError:
+        try:
+            os.symlink(os.path.relpath(src, os.path.dirname(dst)), dst)
+        except OSError:
+            shutil.copy2(src, dst)
+
+
+class Store(util.State):
+    # objects/<ab>/<sha256><ext>, one copy of every attachment for the whole archive
+    def __init__(self, root):
+        self.root = Path(root).resolve()
+        self.root.mkdir(parents=True, exist_ok=True)
+        super().__init__(
+            self.root / "index.json"
+        )  # "photo123_456" => "ab/abcdef....jpg"
+        self.busy = {}  # key => [lock, waiters], so one object is fetched by one thread
+
+    def lookup(self, key):
+        with self.lock:
+            rel = self.items.get(key)
+        if rel and (self.root / rel).is_file():
+            return self.root / rel
+        return None
+
+    @contextlib.contextmanager
+    def key_lock(self, key):
+        # dropped with its last waiter, a long run fetches millions of keys
+        with self.lock:
+            e = self.busy.setdefault(key, [threading.Lock(), 0])
+            e[1] += 1
+        try:
+            with e[0]:
+                yield
+        finally:
+            with self.lock:
+                e[1] -= 1
+                if not e[1]:
+                    del self.busy[key]
+
+    def add(self, tmp, ext):
+        # content address, identical bytes from different objects are kept once
+        sha = util.sha256(tmp)
+        rel = Path(sha[:2], sha + ext)
+        obj = self.root / rel
+        if obj.exists() and obj.stat().st_size == os.path.getsize(tmp):
+            os.unlink(tmp)
+        else:
+            # not there, or cut short through one of its links (--verify)
+            obj.parent.mkdir(exist_ok=True)
+            os.replace(tmp, obj)
+        return rel
+
+    def get(self, key, ext, dst, make, force=False):
+        # links object `key` to `dst` and returns the object, make(path) is called
+        # only if the archive doesn't have it yet; without a key only the stored
+        # bytes are deduplicated
+        with self.key_lock(key) if key else contextlib.nullcontext():
+            obj = None if force or not key else self.lookup(key)
+
+            if obj is None:
+                # named after the object, so what an interrupted run left
+                # (net.download's .part) is picked up by the next one
+                name = hashlib.sha1((key or os.fspath(dst)).encode()).hexdigest()
+                tmp = self.root / f"tmp-{name[:20]}{ext}"
+                try:
+                    make(tmp)
+                    if not tmp.is_file():
+                        return False
+
+                    rel = self.add(tmp, ext)
+                finally:
+                    if tmp.exists():
+                        os.unlink(tmp)
+
+                obj = self.root / rel
+                if key:
+                    with self.lock:
+                        self.items[key] = rel.as_posix()
+                        self.dirty = True
+
+        link(obj, dst)
+        return obj
@@ -0,0 +1,114 @@
+import hashlib
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image
+
+import stages
+import util
+
+
+def digest(path):
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        while chunk := f.read(1 << 20):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def make_thumb(src, dst, w, h):
+    # runs in a worker process, returns the size of the source
+    with Image.open(src) as img:
+        size = img.size
+
+        # jpeg is decoded at 1/2 .. 1/8 scale right away, the rest is resampled
+        img.draft("RGB", (w * 2, h * 2))
+        img = img.convert("RGB").resize(
+            (w, h), Image.Resampling.BICUBIC, reducing_gap=2.0
+        )
+        img.save(dst)
+
+    return size
+
+
+class Thumbs(util.State):
+    # source image => its dimensions, so unchanged photos are never decoded twice
+    def __init__(self, path, workers=None):
+        super().__init__(path)
+        self.workers = workers
+        self.pool = None
+
+    def key(self, src):
+        return os.path.relpath(src, self.path.parent)
+
+    def lookup(self, src):
+        # (width, height) if `src` is the same file as last time
+        try:
+            st = os.stat(src)
+        except OSError:
+            return None
+
+        with self.lock:
+            e = self.items.get(self.key(src))
+
+        if e is None or e["size"] != st.st_size:
+            return None
+
+        # downloaded again (--rewrite), same bytes
+        if e["mtime"] != st.st_mtime_ns:
+            if e["digest"] != digest(src):
+                return None
+            with self.lock:
+                self.items[self.key(src)] = {**e, "mtime": st.st_mtime_ns}
+                self.dirty = True
+
+        return e["width"], e["height"]
+
+    def put(self, src, width, height):
+        st = os.stat(src)
+        e = {
+            "size": st.st_size,
+            "mtime": st.st_mtime_ns,
+            "digest": digest(src),
+            "width": width,
+            "height": height,
+        }
+        with self.lock:
+            self.items[self.key(src)] = e
+            self.dirty = True
+
+    def size(self, src):
+        # only the header is read, pixels stay on disk
+        if size := self.lookup(src):
+            return size
+
+        try:
+            with Image.open(src) as img:
+                size = img.size
+        except Exception:
+            return None
+
+        self.put(src, *size)
+        return size
+
+    def make(self, src, dst, w, h):
+        if os.path.exists(dst) and self.lookup(src):
+            return
+
+        with self.lock:
+            if self.pool is None:
+                # made while dumps run in other threads, fork would copy
+                # whatever locks they hold at that moment
+                spawn = multiprocessing.get_context("spawn")
+                self.pool = ProcessPoolExecutor(self.workers, spawn)
+
+        with stages.stage("thumb"):
+            size = self.pool.submit(make_thumb, src, dst, w, h).result()
+        self.put(src, *size)
+
+    def close(self):
+        self.save()
+        if self.pool:
+            self.pool.shutdown()
+            self.pool = None
@@ -6,40 +6,62 @@ from pathlib import Path
 import requests
 import re
 import os
+import gzip
+import hashlib
+import json
+import mmap
+import multiprocessing
+import functools
+import shutil
+import threading
 import time
 import unicodedata
+from collections import OrderedDict
 
 from yarl import URL
 from email.utils import parsedate_to_datetime
 from aiohttp_socks import ProxyConnector
+from concurrent.futures import ProcessPoolExecutor
 import asyncio
 import aiofiles
 import aiohttp
 from tqdm import tqdm
 
+import net
+import stages
+
 
 def get_with_retries(url, max_retries=10, retry_delay=10, proxy="", headers={}):
+    # pooled connections and the retry policy of net.py, `retry_delay` caps the backoff
     proxies = {"http": proxy, "https": proxy} if proxy else None
 
-    for attempt in range(1, max_retries + 1):
-        try:
-            r = requests.get(url, proxies=proxies, headers=headers, timeout=15)
-            r.raise_for_status()
-            return r
-        except requests.exceptions.HTTPError as e:
-            raise Exception(f"http failed: {e!r}, status: {r.status_code}")
-        except requests.exceptions.RequestException as e:
-            log.warning(f"attempt {attempt} failed: {e!r}. retrying...")
-            time.sleep(retry_delay)
-    raise Exception(f"failed {url} after {max_retries} tries")
+    try:
+        return net.get(url, max_retries, retry_delay, proxies=proxies, headers=headers)
+    except requests.exceptions.HTTPError as e:
+        raise Exception(f"http failed: {e!r}, status: {e.response.status_code}")
+    except requests.exceptions.RequestException:
+        raise Exception(f"failed {url} after {max_retries} tries")
 
 
 async def dw_album(
-    img_dict, dest_folder, proxy=None, concurrency=5, max_retries=5, retry_delay=10
+    img_dict,
+    dest_folder,
+    proxy=None,
+    concurrency=5,
+    max_retries=5,
+    retry_delay=10,
+    manifest=None,
 ):
     Path(dest_folder).mkdir(parents=True, exist_ok=True)
 
-    connector = ProxyConnector.from_url(proxy) if proxy else None
+    # kept connections and cached dns, limited per host like net.py
+    connector = (
+        ProxyConnector.from_url(proxy)
+        if proxy
+        else aiohttp.TCPConnector(
+            limit_per_host=net.POOL_PER_HOST, ttl_dns_cache=net.DNS_TTL
+        )
+    )
     sem = asyncio.Semaphore(concurrency)
     all_len = len(str(len(img_dict)))
 
@@ -62,6 +84,7 @@ async def dw_album(
                     pbar,
                     max_retries,
                     retry_delay,
+                    manifest,
                 )
                 for img in img_dict
             ]
@@ -71,13 +94,14 @@ async def dw_album(
 
 
 async def _dw_photo(
-    img, all_len, session, dest_folder, sem, pbar, max_retries, retry_delay
+    img, all_len, session, dest_folder, sem, pbar, max_retries, retry_delay, manifest
 ):
     # 0000_xxx, 0001_yyy
     filename = f"{img['index']:0{all_len}d}_{URL(img['url']).name}"
     dest_path = Path(dest_folder) / filename
 
-    if dest_path.is_file():
+    # from the manifest when there is one, no stat per photo on a re-run
+    if manifest.has(dest_path) if manifest else dest_path.is_file():
         # log.trace(f"[skip] {dest_path}")
         pbar.update(1)
         return
@@ -91,8 +115,11 @@ async def _dw_photo(
                         return
 
                     r.raise_for_status()
+                    with stages.stage("download") as st:
+                        data = await r.read()
+                        st.bytes = len(data)
                     async with aiofiles.open(dest_path, mode="wb") as f:
-                        await f.write(await r.read())
+                        await f.write(data)
 
                     if img.get("date"):
                         ts = img["date"]
@@ -105,6 +132,8 @@ async def _dw_photo(
 
                     if ts:
                         os.utime(dest_path, (ts, ts))
+                    if manifest:
+                        manifest.put(dest_path, img["url"], r.headers.get("ETag"))
 
                     if img.get("text"):
                         desc_fn = Path(dest_folder) / f"{filename}_description.txt"
@@ -157,6 +186,16 @@ def html_fmt(path):
         f.write(fmt_html)
 
 
+def html_fmt_pool(paths, workers=None):
+    # offline prettify, pages are independent so one process per page; spawned,
+    # forking while the dump threads run can copy a lock someone holds
+    spawn = multiprocessing.get_context("spawn")
+    with stages.stage("html_fmt") as st, ProcessPoolExecutor(workers, spawn) as ex:
+        st.count = len(paths)
+        for _ in ex.map(html_fmt, paths):
+            pass
+
+
 def str_toplus(value) -> str:
     return str(value).lstrip("-")
 
@@ -170,29 +209,78 @@ def str_cut(string, letters, postfix="..."):
     return string[:letters] + (string[letters:] and postfix)
 
 
-def esc(name: str, replacement: str = "_") -> str:
-    allowed_brackets = "()[]{}"
-    r = []
-
-    for ch in name:
-        cat = unicodedata.category(ch)
+class _EscTable(dict):
+    # str.translate() table for esc(), every char is classified once
+    def __init__(self, replacement):
+        self.replacement = replacement
 
-        if ch in '<>:"/\\|?*' or ch == "\x00":
-            r.append(replacement)
-        elif ch in allowed_brackets:
-            r.append(ch)
-        elif cat.startswith(("P", "S", "C")):
-            r.append(replacement)
+    def __missing__(self, code):
+        ch = chr(code)
+        if ch in '<>:"/\\|?*\x00':
+            bad = True
+        elif ch in "()[]{}":
+            bad = False
         else:
-            r.append(ch)
+            bad = unicodedata.category(ch).startswith(("P", "S", "C"))
 
-    r = "".join(r)
+        self[code] = self.replacement if bad else code
+        return self[code]
+
+
+_esc_tables = {}
+_underscores = re.compile(r"_+")
+
+
+@functools.lru_cache(maxsize=8192)
+def esc(name: str, replacement: str = "_") -> str:
+    table = _esc_tables.get(replacement)
+    if table is None:
+        table = _esc_tables[replacement] = _EscTable(replacement)
+
+    r = name.translate(table)
     r = r.rstrip(" .")
-    r = re.sub(r"_+", "_", r)
+    r = _underscores.sub("_", r)
 
     return r[:255]
 
 
+# only links starting a word with http / vk.com, the rest of the text is skipped fast
+_url = re.compile(
+    r"(?<![-a-zA-Zа-яА-Я0-9@:%_\+.~#?&/=])(?=http|vk\.com)"
+    r"[-a-zA-Zа-яА-Я0-9@:%_\+.~#?&//=]{2,256}\.[a-zA-Zа-яА-Я0-9]{2,4}\b(\/[-a-zA-Zа-яА-Я0-9@:%_\+.~#?&//=]*)?"
+)
+
+
+def html_esc(string: str, br: bool = False) -> str:
+    # a few C-level replace() calls beat translate() with multi-char values
+    string = (
+        string.replace("&", "&amp;")
+        .replace('"', "&quot;")
+        .replace("'", "&apos;")
+        .replace(">", "&gt;")
+        .replace("<", "&lt;")
+    )
+    return string.replace("\n", "<br/>\n") if br else string
+
+
+def linkify(string: str) -> str:
+    # escaped text with links, built in one pass over the raw string
+    if "." not in string:
+        return html_esc(string, True)
+
+    r = []
+    pos = 0
+    for m in _url.finditer(string):
+        url = m.group()
+        u = html_esc(url)
+        r.append(html_esc(string[pos : m.start()], True))
+        r.append(f'<a href="{u}" title="{u}">{html_esc(str_cut(url, 50))}</a>')
+        pos = m.end()
+
+    r.append(html_esc(string[pos:], True))
+    return "".join(r)
+
+
 def escut(string: str, letters: int = 200) -> str:
     return str_cut(esc(string), letters)
 
@@ -212,12 +300,176 @@ def append(path: Path | str, data: str, end: str = "\n"):
         f.write(data + end)
 
 
+def open_text(path: Path | str, mode: str = "r"):
+    # .gz is (de)compressed on the fly
+    path = Path(path)
+
+    if path.suffix == ".gz":
+        return gzip.open(path, mode + "t", encoding="utf-8")
+
+    return open(path, mode, encoding="utf-8")
+
+
+class Sink:
+    # long-lived output file, written in chunks of `threshold` chars
+    def __init__(self, path: Path | str, mode: str = "w", threshold: int = 1 << 20):
+        self.path = Path(path)
+        self.file = open_text(self.path, mode)
+        self.threshold = threshold
+        self.buf = []
+        self.size = 0
+
+    def write(self, data: str, end: str = "\n"):
+        self.buf.append(data)
+        self.buf.append(end)
+        self.size += len(data) + len(end)
+
+        if self.size >= self.threshold:
+            self.flush()
+
+    def flush(self):
+        self.file.write("".join(self.buf))
+        self.buf.clear()
+        self.size = 0
+
+    def tell(self) -> int:
+        self.flush()
+        return self.file.tell()
+
+    def close(self):
+        if self.file.closed:
+            return
+        self.flush()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class TokenBucket:
+    # `rate` calls per second on average, `burst` of them back to back
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self) -> float:
+        # reserves a slot and sleeps until it comes, returns the wait
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+
+        if wait:
+            time.sleep(wait)
+        return wait
+
+
+def sha256(path):
+    # mapped instead of read, hashlib lets go of the gil for big buffers
+    with open(path, "rb") as f:
+        if not os.fstat(f.fileno()).st_size:
+            return hashlib.sha256().hexdigest()
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            return hashlib.sha256(m).hexdigest()
+
+
+# seconds between saves of a State during a run, the last one is in full
+SAVE_EVERY = 60
+
+
+class State:
+    # a dict kept in a json file and shared by threads: profiles, thumbnail
+    # sizes, the object index, the manifest; a broken file is started over
+    def __init__(self, path):
+        self.path = Path(path).resolve()
+        self.items = {}
+        self.dirty = False
+        self.lock = threading.Lock()
+        self.saving = threading.Lock()  # saves one after another, in order
+        self.saved_at = time.monotonic()
+
+        self.loaded = self.path.is_file()
+        if self.loaded:
+            try:
+                with open(self.path, encoding="utf-8") as f:
+                    self.items = json.load(f)
+            except Exception as ex:
+                log.warning(f"{self.path.name} is broken, starting over: {ex!r}")
+                self.loaded = False
+
+    def save(self, every=0):
+        # at most once in `every` seconds; `lock` is only held for a copy, a
+        # big file is written while the other threads go on
+        with self.saving:
+            with self.lock:
+                if not self.dirty or time.monotonic() - self.saved_at < every:
+                    return False
+                items = dict(self.items)
+                self.dirty = False
+
+            try:
+                tmp = self.path.with_suffix(".tmp")
+                with open(tmp, "w", encoding="utf-8") as f:
+                    json.dump(items, f, ensure_ascii=False)
+                os.replace(tmp, self.path)
+            except Exception:
+                with self.lock:
+                    self.dirty = True
+                raise
+            self.saved_at = time.monotonic()
+        return True
+
+
+class LRU:
+    # dict with a size limit, the least recently used entry goes first
+    def __init__(self, maxsize: int = 1024):
+        self.maxsize = maxsize
+        self.items = OrderedDict()
+        self.hits = self.misses = 0
+
+    def get(self, key):
+        value = self.items.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+
+        self.items.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        self.items[key] = value
+        self.items.move_to_end(key)
+        if len(self.items) > self.maxsize:
+            self.items.popitem(last=False)
+
+
 def write(path: Path | str, data: str, end: str = "\n"):
     path = Path(path)
     with open(path, "w", encoding="utf-8") as f:
         f.write(data + end)
 
 
+def copy_changed(src, dst):
+    # copytree() copy_function that leaves identical files untouched
+    try:
+        s, d = os.stat(src), os.stat(dst)
+        if s.st_size == d.st_size and int(s.st_mtime) == int(d.st_mtime):
+            return dst
+    except FileNotFoundError:
+        pass
+
+    return shutil.copy2(src, dst)
+
+
 def delete(path: Path | str):
     path = Path(path)
     rem_file = Path(path)
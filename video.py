@@ -0,0 +1,102 @@
+import io
+import os
+import threading
+import time
+
+import yt_dlp
+from loguru import logger as log
+
+import stages
+
+
+class Videos:
+    # yt-dlp instances live as long as their threads, extractors are set up once
+    def __init__(self, opts, cookies=""):
+        self.opts = opts
+        self.cookies = cookies
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.instances = []
+        self.infos = {}  # owner_id_id => probed info, None if it can't be downloaded
+        self.urls = {}  # owner_id_id => url, infos are dropped once downloaded
+        self.count = 0
+        self.bytes = 0
+        self.seconds = 0.0
+
+    def ydl(self):
+        ydl = getattr(self.local, "ydl", None)
+        if ydl is None:
+            opts = {**self.opts, "cookiefile": io.StringIO(self.cookies)}
+            ydl = self.local.ydl = yt_dlp.YoutubeDL(opts)
+            with self.lock:
+                self.instances.append(ydl)
+        return ydl
+
+    def probe(self, v_id, url):
+        # formats only, a few kb; the same video in many messages is asked once
+        with self.lock:
+            self.urls[v_id] = url
+            if v_id in self.infos:
+                return self.infos[v_id]
+
+        try:
+            info = self.ydl().extract_info(url, download=False)
+        except Exception as ex:
+            log.debug(f"video {v_id}: {ex!r}")
+            info = None
+
+        with self.lock:
+            self.infos[v_id] = info
+        return info
+
+    def download(self, v_id, path):
+        with self.lock:
+            downloaded = v_id not in self.infos
+            info = self.infos.get(v_id)
+
+        # the same video again (--rewrite), formats have to be asked for again
+        if downloaded:
+            info = self.probe(v_id, self.urls[v_id])
+        if info is None:
+            return
+
+        # the instance belongs to this thread, so the template can change per file
+        ydl = self.ydl()
+        ydl.params["outtmpl"] = {"default": os.fspath(path)}
+
+        start = time.perf_counter()
+        try:
+            with stages.stage("video") as st:
+                ydl.process_ie_result(info, download=True)
+                st.bytes = os.path.getsize(path) if os.path.exists(path) else 0
+        except Exception:
+            with self.lock:
+                self.infos[v_id] = None
+            raise
+
+        elapsed = time.perf_counter() - start
+        size = st.bytes
+        with self.lock:
+            self.infos.pop(v_id, None)
+            self.count += 1
+            self.bytes += size
+            self.seconds += elapsed
+
+        mb = size / 2**20
+        log.info(
+            f"video {v_id}: {mb:.1f} MB in {elapsed:.1f}s, {mb / max(elapsed, 1e-3):.2f} MB/s"
+        )
+
+    def summary(self):
+        with self.lock:
+            mb = self.bytes / 2**20
+            speed = mb / max(self.seconds, 1e-3)
+            return (
+                f"video: {self.count} files, {mb:.1f} MB, {speed:.2f} MB/s per download"
+            )
+
+    def close(self):
+        with self.lock:
+            for ydl in self.instances:
+                ydl.close()
+            self.instances.clear()